@@ -18,18 +18,26 @@ import sys, os
 import logging
 import glob
 import shutil
+import time
+
+from concurrent.futures import ThreadPoolExecutor
 
 
 from version import __version__
-from flickr import Flickr
+from flickr import Flickr, PhotoIndex
+from download import Downloader
 from flashair import FlashAir
 from facebookphotos import FacebookPhotos
-from PIL import Image
+from naming import ContentHasher
+from timing import StageTimer
+from pipeline import PhotoStream
+import imaging
+import pipeline
 
 class AirFrame(object):
 
     def __init__(self):
-        pass
+        self.timer = StageTimer()
 
     def _parse_csv_list(self, s):
         try:
@@ -40,6 +48,12 @@ class AirFrame(object):
             raise argparse.ArgumentTypeError("Could not parse tag list")
         return value_list
 
+    def _parse_bytes(self, s):
+        try:
+            return imaging.parse_bytes(s)
+        except ValueError:
+            raise argparse.ArgumentTypeError("Could not parse byte count %s" % s)
+
     def get_options(self, argv):
         """
             Parse the command-line options and set the following object properties:
@@ -69,6 +83,21 @@ class AirFrame(object):
         p.add_argument('-s', '--resize', type=str,
             help='Resize all images to fit in this box (e.g. 1024x768) before uploading them to Flashair')
 
+        p.add_argument('-j', '--jobs', type=int,
+            default=None, dest='jobs', help='Number of pictures to resize in parallel (default: number of cores)')
+
+        p.add_argument('--max-bytes', type=self._parse_bytes,
+            default=None, dest='max_bytes', help='Re-encode pictures at the highest quality that fits in this many bytes (e.g. 300k), to speed up the upload to the FlashAir')
+
+        p.add_argument('--quality', type=int,
+            default=imaging.DEFAULT_QUALITY, dest='quality', help='JPEG quality of resized pictures, and the most --max-bytes will use (default: %d)' % imaging.DEFAULT_QUALITY)
+
+        p.add_argument('--optimize', action='store_true',
+            default=False, dest='optimize', help='Write optimized JPEGs, which are a little smaller but slower to encode')
+
+        p.add_argument('--cache-size', type=int,
+            default=500, dest='cache_size', help='Max size in MB of the cache of resized pictures (default: 500)')
+
         p.add_argument('-d', '--debug', action='store_true',
             default=False, dest='debug', help='Turn on debugging')
 
@@ -84,22 +113,69 @@ class AirFrame(object):
         p.add_argument('-t', '--tags', type=self._parse_csv_list,
                 default=[], dest='tags', help='List of Flickr tags to match')
 
-        p.add_argument('flashair_ip', type=str,
-                        help='The ip/hostname of your FlashAir card')
+        p.add_argument('--download-workers', type=int,
+            default=4, dest='download_workers', help='Number of photos to download from Flickr at once (default: 4)')
+
+        p.add_argument('-w', '--card-workers', type=int,
+            default=1, dest='card_workers', help='Max number of deletes/uploads in flight to the FlashAir at once (default: 1)')
+
+        p.add_argument('--max-kbps', type=int,
+            default=None, dest='max_kbps', help='Cap the upload rate to the FlashAir at this many kilobits per second')
+
+        p.add_argument('--content-names', action='store_true',
+            default=False, dest='content_names', help='Name files on the FlashAir by a hash of their contents, so identical pictures are only uploaded once')
+
+        p.add_argument('--shards', type=int,
+            default=1, dest='shards', help='Spread the photos across this many directories on the FlashAir (100__TSB, 101__TSB, ...)')
+
+        p.add_argument('--shard-cap', type=int,
+            default=1000, dest='shard_cap', help='Max number of photos in each FlashAir directory when using --shards (default: 1000)')
+
+        p.add_argument('--bulk-delete', action='store_true',
+            default=False, dest='bulk_delete', help='Delete old pictures with a helper Lua script on the FlashAir, in one request instead of one per file')
+
+        p.add_argument('--pipeline', action='store_true',
+            default=False, dest='pipeline', help='Download, resize and upload pictures at the same time, instead of one stage after another')
+
+        p.add_argument('--hosts-file', type=str,
+            dest='hosts_file', help='File listing the ip/hostname of each FlashAir card to sync, one per line')
+
+        p.add_argument('flashair_ip', type=str, nargs='*',
+                        help='The ip/hostname of your FlashAir card (or cards)')
 
 
         args = p.parse_args(argv)
 
+        hosts = list(args.flashair_ip)
+        if args.hosts_file:
+            hosts.extend(self._read_hosts_file(args.hosts_file))
+        if not hosts:
+            p.error("at least one FlashAir ip/hostname is required")
+
         self.debug = args.debug
         self.verbose = args.verbose
         self.photo_count = args.number
         self.photo_tags = args.tags
         self.force_upload = args.force
-        self.flashair_ip = args.flashair_ip
+        self.flashair_hosts = hosts
+        self.flashair_ip = hosts[0]
         self.local_dir = args.local_dir
         self.resize = args.resize
+        self.jobs = args.jobs
+        self.cache_size = args.cache_size
+        self.max_bytes = args.max_bytes
+        self.quality = args.quality
+        self.optimize = args.optimize
         self.facebook = args.facebook
         self.flickr = args.flickr
+        self.card_workers = args.card_workers
+        self.download_workers = args.download_workers
+        self.max_kbps = args.max_kbps
+        self.content_names = args.content_names
+        self.shards = args.shards
+        self.shard_cap = args.shard_cap
+        self.bulk_delete = args.bulk_delete
+        self.pipeline = args.pipeline
 
         if self.debug:
             logging.basicConfig(level=logging.DEBUG, format='%(message)s')
@@ -107,28 +183,57 @@ class AirFrame(object):
         if self.verbose:
             logging.basicConfig(level=logging.INFO, format='%(message)s')
 
-    def flickr_mode(self):
+    def _read_hosts_file(self, filename):
+        """
+            :returns: the hostnames in the file, ignoring blank lines and # comments
+        """
+        hosts = []
+        with open(filename) as f:
+            for line in f:
+                host = line.split('#')[0].strip()
+                if host:
+                    hosts.append(host)
+        return hosts
+
+    def fetch_photos(self, stream=False):
+        """
+            :param stream: Return a PhotoStream that fetches the photos as it
+                           is iterated over, instead of fetching them all first
+            :returns: the local photo files
+        """
+        if self.local_dir:
+            return self.local_dir_mode(stream)
+        elif self.facebook:
+            return self.facebook_mode(stream)
+        else:
+            return self.flickr_mode(stream)
+
+    def _downloader(self):
+        return Downloader(self.download_workers, index_filename=os.path.join(self.cache_dir, "downloads.json"))
+
+    def flickr_mode(self, stream=False):
         # Connect to Flickr
         logging.debug("list of tags: %s" % self.photo_tags)
-        self.flickr = Flickr()
+        index = PhotoIndex(os.path.join(self.cache_dir, "flickr_index.json"))
+        self.flickr = Flickr(self._downloader(), self._resize_box(), index)
         if len(self.photo_tags) > 0:
-            photo_filenames = self.flickr.get_tagged(self.photo_tags, self.photo_count, download_dir=self.download_dir)
+            photo_filenames = self.flickr.get_tagged(self.photo_tags, self.photo_count, download_dir=self.download_dir, stream=stream)
         else:
-            photo_filenames = self.flickr.get_recent(self.photo_count,download_dir=self.download_dir)
+            photo_filenames = self.flickr.get_recent(self.photo_count,download_dir=self.download_dir, stream=stream)
         return photo_filenames
 
-    def facebook_mode(self):
+    def facebook_mode(self, stream=False):
         # Connect to Facebook
         logging.debug("list of tags: %s" % self.photo_tags)
-        self.facebookphotos = FacebookPhotos()
+        self.facebookphotos = FacebookPhotos(self._resize_box(), self._downloader())
 #        if len(self.photo_tags) > 0:
 #            photo_filenames = self.flickr.get_tagged(self.photo_tags, self.photo_count, download_dir=self.download_dir)
 #        else:
 #            photo_filenames = self.flickr.get_recent(self.photo_count,download_dir=self.download_dir)
-        photo_filenames = self.facebookphotos.get_recent(self.photo_count,download_dir=self.download_dir)
+        photo_filenames = self.facebookphotos.get_recent(self.photo_count,download_dir=self.download_dir, stream=stream)
         return photo_filenames
 
-    def local_dir_mode(self):
+    def local_dir_mode(self, stream=False):
         # Copy all the files in the named directory to the cache (download_dir).
         # completely replaces both the local cached files and the ones on the 
         # wifi sd card
@@ -142,39 +247,151 @@ class AirFrame(object):
         os.mkdir(self.download_dir)
         logging.debug("caching files from: %s" % match)
         photo_filenames = glob.glob(match)
+        # Work on the cached copies, so resizing never touches the originals
+        cached_filenames = [os.path.join(self.download_dir, os.path.basename(fn)) for fn in photo_filenames]
+        copies = self._copy_files(photo_filenames)
+        if stream:
+            return PhotoStream(cached_filenames, copies)
+        return list(copies)
+
+    def _copy_files(self, photo_filenames):
         for filename in photo_filenames:
             logging.debug("copy %s to %s" % (filename, self.download_dir))
-            shutil.copy(filename, self.download_dir)
-        return photo_filenames    
+            # Keep the modification time, so the content hashes stay cached
+            shutil.copy2(filename, self.download_dir)
+            yield os.path.join(self.download_dir, os.path.basename(filename))
 
     def resize_pictures(self, photo_filenames):
+        """
+            Get resized (and re-encoded) copies of the pictures from the
+            derivative cache, resizing the ones that aren't in it yet in parallel.
+
+            :returns: the resized copies of the pictures that could be resized
+        """
         print 'Resizing images...'
-        size = self.resize.split('x')
-        size = [int(x) for x in tuple(size)]
-        for infile in photo_filenames:
-            im = Image.open(infile)
-            if im.size[0] > size[0] or im.size[1] > size[1]:
-                im.thumbnail(size, Image.ANTIALIAS)
-                im.save(infile)
-            im.close()
+        return list(self._resized(self._derivative_cache().resize(photo_filenames, self._resize_box(), self.jobs)))
+
+    def resize_stream(self, photo_filenames):
+        """
+            Like :meth:`resize_pictures`, but resizes the pictures as they
+            arrive, and produces each one as soon as it is ready.
+        """
+        return self._resized(self._derivative_cache().resize_iter(photo_filenames, self._resize_box(), self.jobs))
+
+    def _resize_box(self):
+        return imaging.parse_size(self.resize) if self.resize else None
+
+    def _derivative_cache(self):
+        encoding = {'quality': self.quality, 'max_bytes': self.max_bytes, 'optimize': self.optimize}
+        return imaging.DerivativeCache(os.path.join(self.cache_dir, "derived"), self.hasher,
+                                       self.cache_size*1024*1024, encoding)
+
+    def _resized(self, results):
+        for filename, error in results:
+            if error:
+                print("Could not resize %s, skipping it: %s" % (filename, error))
+            else:
+                yield filename
 
 
     def go(self, argv):
         self.download_dir = ".airframe"
+        # Kept separately from download_dir, which local_dir_mode clears on every run
+        self.cache_dir = ".airframe_cache"
         self.get_options(argv)
-
-        if self.local_dir:
-            photo_filenames = self.local_dir_mode()
-        elif self.facebook:
-            photo_filenames = self.facebook_mode()
+        self.hasher = ContentHasher(os.path.join(self.cache_dir, "hashes.json"))
+
+        if self.pipeline:
+            if self.content_names or len(self.flashair_hosts) > 1:
+                print("--pipeline can't be used with --content-names or several cards, running one stage after another")
+            else:
+                with self.timer.stage('pipeline'):
+                    self.flashair = self.sync_pipeline(self.flashair_ip)
+                return
+
+        with self.timer.stage('fetch'):
+            photo_filenames = self.fetch_photos()
+
+        if self.resize or self.max_bytes:
+            with self.timer.stage('resize'):
+                photo_filenames = self.resize_pictures(photo_filenames)
+            self.hasher.save()
+
+        if len(self.flashair_hosts) == 1:
+            self.flashair = self.sync_card(self.flashair_ip, photo_filenames)
         else:
-            photo_filenames = self.flickr_mode()
+            self.sync_fleet(photo_filenames)
+
+    def _flashair(self, hostname):
+        return FlashAir(hostname, workers=self.card_workers, max_kbps=self.max_kbps,
+                        manifest_dir=self.cache_dir, hasher=self.hasher if self.content_names else None,
+                        shards=self.shards, shard_cap=self.shard_cap, bulk_delete=self.bulk_delete,
+                        timer=self.timer)
 
-        if self.resize:
-            self.resize_pictures(photo_filenames)
+    def sync_pipeline(self, hostname):
+        """
+            Fetch, resize and upload the photos as a pipeline, so one photo can
+            be uploading while the next is resizing and the one after that is
+            downloading.  Each stage runs in its own thread, with a bounded
+            queue to the next one.
+
+            :returns: the FlashAir after syncing the photos to it
+        """
+        photos = self.fetch_photos(stream=True)
+        ready = pipeline.background(photos)
+        if self.resize or self.max_bytes:
+            print 'Resizing images...'
+            ready = pipeline.background(self.resize_stream(ready))
 
-        self.flashair = FlashAir(self.flashair_ip)
-        self.flashair.sync_files_on_card_to_list(photo_filenames, self.force_upload)
+        flashair = self._flashair(hostname)
+        try:
+            flashair.sync_stream(photos.filenames, ready, self.force_upload)
+        finally:
+            flashair.close()
+            self.hasher.save()
+        return flashair
+
+    def sync_card(self, hostname, photo_filenames):
+        """
+            :returns: the FlashAir after syncing the photos to it
+        """
+        flashair = self._flashair(hostname)
+        try:
+            flashair.sync_files_on_card_to_list(photo_filenames, self.force_upload)
+        finally:
+            flashair.close()
+        return flashair
+
+    def _sync_card_timed(self, hostname, photo_filenames):
+        start = time.time()
+        try:
+            flashair = self.sync_card(hostname, photo_filenames)
+            return (hostname, time.time() - start, flashair.progress.total_bytes, None)
+        except Exception as e:
+            logging.debug("Sync to %s failed", hostname, exc_info=True)
+            return (hostname, time.time() - start, 0, e)
+
+    def sync_fleet(self, photo_filenames):
+        """
+            Sync the same set of photos to every card at once, each over its
+            own connection and with its own plan, then print a summary.
+        """
+        print("Syncing %d photos to %d FlashAir cards" % (len(photo_filenames), len(self.flashair_hosts)))
+        pool = ThreadPoolExecutor(max_workers=len(self.flashair_hosts))
+        futures = [pool.submit(self._sync_card_timed, host, photo_filenames) for host in self.flashair_hosts]
+        pool.shutdown(wait=True)
+
+        self.fleet_results = [f.result() for f in futures]
+        print("FlashAir sync summary:")
+        for hostname, seconds, nbytes, error in self.fleet_results:
+            if error:
+                print("  %s: FAILED after %.1fs (%s)" % (hostname, seconds, error))
+            else:
+                print("  %s: %.1fs, %d KB sent" % (hostname, seconds, nbytes/1024))
+        failed = [hostname for hostname, seconds, nbytes, error in self.fleet_results if error]
+        if failed:
+            # Fail the run as a single card's error would, so cron notices
+            raise IOError("%d of %d FlashAir cards failed to sync: %s" % (len(failed), len(self.fleet_results), ", ".join(failed)))
 
 def main():
     script = AirFrame()
@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright 2013 Virantha Ekanayake All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""
+    End-to-end sync benchmark.
+
+    Runs ``AirFrame.go`` over synthetic JPEG corpora, syncing to a local
+    FlashAir emulator, and records wall time, requests, bytes sent, peak
+    RSS and the time in each stage.  Results can be saved as a JSON
+    baseline, and later runs are compared against it::
+
+        $ python -m airframe.benchmark --save
+        $ python -m airframe.benchmark --corpus 100x1024x768 --threshold 0.2
+        $ python -m airframe.benchmark -- --pipeline --card-workers 2
+"""
+import argparse
+import sys, os
+import logging
+import json
+import random
+import resource
+import shutil
+import subprocess
+import time
+
+from PIL import Image, ImageDraw
+
+from emulator import FlashAirEmulator
+
+DEFAULT_CORPORA = ["100x1024x768", "1000x1024x768", "10000x320x240", "100x4000x3000"]
+
+# Differences smaller than these are noise, whatever the relative change
+MIN_DIFFERENCE = {'wall': 0.25, 'requests': 5, 'bytes_sent': 64*1024, 'peak_rss_kb': 8*1024}
+MIN_STAGE_DIFFERENCE = 0.1
+
+
+def parse_corpus(spec):
+    """
+        :param spec: COUNTxWIDTHxHEIGHT, e.g. 100x1024x768
+        :returns: (count, (width, height))
+    """
+    try:
+        count, width, height = [int(x) for x in spec.split('x')]
+    except ValueError:
+        raise argparse.ArgumentTypeError("Corpus must look like COUNTxWIDTHxHEIGHT, not %s" % spec)
+    return count, (width, height)
+
+
+def make_image(filename, size, seed):
+    """ Write a distinct, deterministic JPEG of the given size """
+    rnd = random.Random(seed)
+    im = Image.new('RGB', size, (rnd.randint(0, 255), rnd.randint(0, 255), rnd.randint(0, 255)))
+    draw = ImageDraw.Draw(im)
+    width, height = size
+    for _ in range(20):
+        x, y = rnd.randint(0, width), rnd.randint(0, height)
+        box = [x, y, x + rnd.randint(1, width/2 + 1), y + rnd.randint(1, height/2 + 1)]
+        draw.rectangle(box, fill=(rnd.randint(0, 255), rnd.randint(0, 255), rnd.randint(0, 255)))
+    # Some noise so the images compress like photos rather than flat blocks
+    noise = Image.effect_noise((max(1, width/4), max(1, height/4)), 40).resize(size).convert('RGB')
+    Image.blend(im, noise, 0.3).save(filename, quality=90)
+
+
+def make_corpus(dirname, count, size):
+    """ Create the corpus, unless it is already there """
+    if not os.path.exists(dirname):
+        os.makedirs(dirname)
+    existing = set(os.listdir(dirname))
+    if len(existing) == count:
+        return
+    print("Creating %d synthetic %dx%d photos in %s" % (count, size[0], size[1], dirname))
+    for i in xrange(count):
+        name = "IMG%05d.jpg" % i
+        if name not in existing:
+            make_image(os.path.join(dirname, name), size, i)
+
+
+def run_one(workdir, argv, result_filename):
+    """
+        Run one sync in this process and write its measurements to a file.
+        Runs in a child process so peak RSS only covers this sync.
+    """
+    from airframe import AirFrame
+
+    os.chdir(workdir)
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        script = AirFrame()
+        start = time.time()
+        script.go(argv)
+        wall = time.time() - start
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+    # ru_maxrss is in KB on Linux
+    peak_rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                   resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    with open(result_filename, 'w') as f:
+        json.dump({'wall': wall, 'peak_rss_kb': peak_rss, 'stages': script.timer.times}, f)
+
+
+def run_scenario(name, corpus_dir, workdir, emulator, extra_args, fresh):
+    """
+        :param fresh: start with an empty working directory (no caches or manifests)
+        :returns: dict of measurements
+    """
+    if fresh and os.path.exists(workdir):
+        shutil.rmtree(workdir)
+    if not os.path.exists(workdir):
+        os.makedirs(workdir)
+
+    argv = ['-l', os.path.abspath(corpus_dir)] + extra_args + [emulator.hostname]
+    result_filename = os.path.abspath(os.path.join(workdir, "result.json"))
+    package_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([package_root] + [x for x in [env.get('PYTHONPATH')] if x])
+
+    emulator.reset_stats()
+    subprocess.check_call([sys.executable, '-m', 'airframe.benchmark', '--run-one', os.path.abspath(workdir),
+                           result_filename, '--'] + argv, env=env)
+    with open(result_filename) as f:
+        result = json.load(f)
+    result['requests'] = emulator.stats['requests']
+    result['bytes_sent'] = emulator.stats['bytes_received']
+    print("%-28s %8.2fs %7d requests %10d KB sent %8d KB peak RSS  %s" % (
+            name, result['wall'], result['requests'], result['bytes_sent']/1024, result['peak_rss_kb'],
+            " ".join("%s=%.2fs" % (k, v) for k, v in sorted(result['stages'].items()))))
+    return result
+
+
+def compare(results, baseline, threshold):
+    """
+        :returns: list of regression messages, for every metric that got
+                  worse than the baseline by more than threshold
+    """
+    regressions = []
+    for name, result in sorted(results.items()):
+        base = baseline.get(name)
+        if not base:
+            continue
+        metrics = [(key, result[key], base.get(key), MIN_DIFFERENCE[key]) for key in MIN_DIFFERENCE]
+        metrics += [("stage %s" % stage, seconds, base.get('stages', {}).get(stage), MIN_STAGE_DIFFERENCE)
+                    for stage, seconds in result['stages'].items()]
+        for key, value, base_value, min_difference in metrics:
+            if base_value is None:
+                continue
+            if value > base_value * (1 + threshold) and value - base_value > min_difference:
+                regressions.append("%s: %s went from %.2f to %.2f (+%.0f%%)" % (
+                        name, key, base_value, value, 100.0 * (value - base_value) / max(base_value, 1e-9)))
+    return regressions
+
+
+def parse_args(argv=None):
+    p = argparse.ArgumentParser(description="Benchmark airframe syncs against a local FlashAir emulator")
+    p.add_argument('--corpus', type=str, action='append', dest='corpora',
+                   help='Synthetic corpus to sync, as COUNTxWIDTHxHEIGHT (can be repeated, default: %s)' % ", ".join(DEFAULT_CORPORA))
+    p.add_argument('--dir', type=str, default='.airframe_bench', help='Where to keep the corpora and working directories')
+    p.add_argument('--baseline', type=str, default='benchmark_baseline.json', help='JSON baseline file')
+    p.add_argument('--save', action='store_true', default=False, help='Save the results as the new baseline')
+    p.add_argument('--threshold', type=float, default=0.2, help='Flag metrics more than this fraction worse than the baseline')
+    p.add_argument('--resize', type=str, default='1024x768', help='Resize box passed to airframe, empty to skip resizing')
+    p.add_argument('--latency', type=float, default=0.0, help='Emulated per-request latency of the card in seconds')
+    p.add_argument('--throughput', type=int, default=None, help='Emulated card throughput in bytes per second')
+    # argparse takes a lone value starting with -- for an option, so it needs the = form
+    p.add_argument('--airframe-args', type=str, default='',
+                   help='Extra arguments for airframe, e.g. --airframe-args="--pipeline" (or pass them after --)')
+    p.add_argument('--run-one', nargs=2, help=argparse.SUPPRESS)
+    p.add_argument('argv', nargs='*', metavar='AIRFRAME_ARG',
+                   help='Extra arguments for airframe, after a -- separator')
+    return p.parse_args(argv)
+
+
+def main():
+    args = parse_args()
+
+    if args.run_one:
+        run_one(args.run_one[0], args.argv, args.run_one[1])
+        return
+
+    extra_args = args.airframe_args.split() + args.argv
+    if args.resize:
+        extra_args += ['-s', args.resize]
+
+    results = {}
+    for spec in args.corpora or DEFAULT_CORPORA:
+        count, size = parse_corpus(spec)
+        corpus_dir = os.path.join(args.dir, "corpus", spec)
+        workdir = os.path.join(args.dir, "work", spec)
+        make_corpus(corpus_dir, count, size)
+
+        emulator = FlashAirEmulator(latency=args.latency, throughput=args.throughput, store_data=False)
+        with emulator:
+            results["%s initial" % spec] = run_scenario("%s initial" % spec, corpus_dir, workdir, emulator, extra_args, True)
+            results["%s resync" % spec] = run_scenario("%s resync" % spec, corpus_dir, workdir, emulator, extra_args, False)
+
+    baseline = {}
+    if os.path.isfile(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    regressions = compare(results, baseline, args.threshold)
+    for message in regressions:
+        print("REGRESSION %s" % message)
+
+    if args.save:
+        baseline.update(results)
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        print("Saved baseline to %s" % args.baseline)
+
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
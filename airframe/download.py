@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright 2013 Virantha Ekanayake All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import sys, os
+import logging
+import json
+import threading
+from collections import deque
+
+import requests
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
+
+JPEG_SOI = b"\xff\xd8"
+JPEG_EOI = b"\xff\xd9"
+# Bytes at the end of a JPEG searched for its end-of-image marker; some cameras pad the file
+EOI_SEARCH = 1024
+
+
+def is_complete_jpeg(filename):
+    """
+        :returns: True if the file is a JPEG that wasn't cut short, i.e. it
+                  ends with an end-of-image marker
+    """
+    size = os.path.getsize(filename)
+    with open(filename, 'rb') as f:
+        if f.read(2) != JPEG_SOI:
+            return False
+        f.seek(max(2, size - EOI_SEARCH))
+        tail = f.read().rstrip(b"\x00")
+    return tail.endswith(JPEG_EOI)
+
+
+class Downloader(object):
+    """
+        Downloads photos several at a time, over a pool of keep-alive
+        connections to each host, so a sync doesn't pay for a new connection
+        per photo.
+
+        Every download goes to a temporary file that is only renamed into
+        place once it has all the bytes the server said it would send, and
+        the size of each finished download is recorded, so a partial file
+        from an interrupted run is never mistaken for a cached photo.  A
+        download that is cut short is resumed with a Range request next
+        time, if the server supports them.
+    """
+    def __init__(self, workers=4, session=None, connect_timeout=10.0, read_timeout=60.0,
+                 chunk_size=64*1024, index_filename=None):
+        """
+            :param workers: Number of downloads in flight at once
+            :param session: Optional pre-configured session to use instead of creating one
+            :type session: requests.Session
+            :param connect_timeout: Seconds to wait for a connection
+            :param read_timeout: Seconds to wait for the server to send more data
+            :param chunk_size: Bytes read and written at a time
+            :param index_filename: JSON file recording the size of every
+                                   finished download, or None to keep it in memory
+        """
+        self.workers = max(1, workers)
+        self.timeout = (connect_timeout, read_timeout)
+        self.chunk_size = chunk_size
+        self.index_filename = index_filename
+        self.lock = threading.Lock()
+        self.sizes = {}
+        if index_filename and os.path.isfile(index_filename):
+            try:
+                with open(index_filename) as f:
+                    self.sizes = json.load(f)
+            except ValueError:
+                logging.debug("Ignoring unreadable download index %s" % index_filename)
+        if session is None:
+            session = self._create_session()
+        self.session = session
+
+    def _create_session(self):
+        session = requests.Session()
+        # Photos come from a handful of CDN hosts; keep a pool of connections to each
+        adapter = HTTPAdapter(pool_connections=8, pool_maxsize=self.workers)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+    def close(self):
+        self.session.close()
+
+    def is_cached(self, filename):
+        """
+            A file with a recorded size is complete if it still has that size.
+            A JPEG downloaded before the index existed is trusted if it ends
+            with an end-of-image marker, and is recorded from then on.
+
+            :returns: True if the file is a complete earlier download
+        """
+        if not os.path.isfile(filename):
+            return False
+        path = os.path.abspath(filename)
+        with self.lock:
+            size = self.sizes.get(path)
+        if size is not None:
+            return os.path.getsize(filename) == size
+        if not is_complete_jpeg(filename):
+            return False
+        with self.lock:
+            self.sizes[path] = os.path.getsize(filename)
+        return True
+
+    def download(self, url, filename, cache=True):
+        """
+            :param cache: Keep a complete earlier download instead of downloading it again
+            :returns: filename
+            :raises: IOError if the download was cut short, or requests.RequestException
+        """
+        if cache and self.is_cached(filename):
+            return filename
+        dirname = os.path.dirname(filename)
+        if dirname and not os.path.exists(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError:
+                # Another download created it first
+                pass
+
+        tmp = filename + ".part"
+        validator = self._read_validator(tmp)
+        offset = os.path.getsize(tmp) if validator and os.path.isfile(tmp) else 0
+        headers = {}
+        if offset:
+            # Ask for the rest of an interrupted download, byte for byte, but
+            # for all of it if the photo has changed since
+            headers = {'Range': "bytes=%d-" % offset, 'If-Range': validator, 'Accept-Encoding': "identity"}
+        r = self.session.get(url, stream=True, timeout=self.timeout, headers=headers)
+        # A partial file we already had is kept through a failed attempt to resume it
+        resumable = bool(offset)
+        try:
+            if r.status_code == 416 and offset:
+                # The partial file is no use, e.g. the photo has changed since
+                self._discard(tmp)
+                r.close()
+                return self.download(url, filename, cache=False)
+            r.raise_for_status()
+            if r.status_code == 206:
+                # A different range than we asked for means the partial file can't be trusted
+                resumable = False
+                expected = self._resumed_size(r, offset)
+            else:
+                # The server sent the whole photo
+                offset = 0
+                expected = r.headers.get('Content-Length')
+                # A compressed response is decoded on the fly, so its length can't be checked
+                expected = int(expected) if expected is not None and 'Content-Encoding' not in r.headers else None
+                validator = self._validator(r)
+                self._write_validator(tmp, validator)
+            # Only resume with a validator, so a changed photo is never spliced onto the old one
+            resumable = bool(validator) and (r.headers.get('Accept-Ranges') == 'bytes' or r.status_code == 206)
+            received = offset
+            with open(tmp, 'ab' if offset else 'wb') as f:
+                for chunk in r.iter_content(self.chunk_size):
+                    f.write(chunk)
+                    received += len(chunk)
+            if expected is not None and received != expected:
+                raise IOError("Download of %s was cut short: got %d of %d bytes" % (url, received, expected))
+            if expected is None and not is_complete_jpeg(tmp):
+                # Photos are all JPEGs, so without a length the end-of-image marker has to do
+                raise IOError("Download of %s is not a complete JPEG" % url)
+        except:
+            # Keep what we have if the rest can be asked for next time
+            if not (resumable and os.path.isfile(tmp) and os.path.getsize(tmp) > 0):
+                self._discard(tmp)
+            raise
+        finally:
+            r.close()
+
+        os.rename(tmp, filename)
+        self._discard(tmp)
+        with self.lock:
+            self.sizes[os.path.abspath(filename)] = received
+        return filename
+
+    def _validator(self, r):
+        """ :returns: the response's ETag or Last-Modified, for an If-Range header, or None """
+        etag = r.headers.get('ETag')
+        # Weak ETags can't be used with If-Range
+        if etag and not etag.startswith('W/'):
+            return etag
+        return r.headers.get('Last-Modified')
+
+    def _read_validator(self, tmp):
+        try:
+            with open(tmp + ".validator") as f:
+                return f.read().strip() or None
+        except IOError:
+            return None
+
+    def _write_validator(self, tmp, validator):
+        if validator:
+            with open(tmp + ".validator", 'w') as f:
+                f.write(validator)
+        elif os.path.exists(tmp + ".validator"):
+            os.remove(tmp + ".validator")
+
+    def _discard(self, tmp):
+        """ Remove a partial download and its validator """
+        for path in (tmp, tmp + ".validator"):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _resumed_size(self, r, offset):
+        """
+            :returns: the full size of the photo from a 206 response's Content-Range, if known
+            :raises: IOError if the server sent a different range than was asked for
+        """
+        # e.g. Content-Range: bytes 1000-9999/10000
+        content_range = r.headers.get('Content-Range', '')
+        try:
+            start, total = content_range.split(' ', 1)[1].split('-', 1)[0], content_range.rsplit('/', 1)[1]
+            start = int(start)
+        except (IndexError, ValueError):
+            raise IOError("Unexpected Content-Range '%s' for %s" % (content_range, r.url))
+        if start != offset:
+            raise IOError("Asked for %s from byte %d but got '%s'" % (r.url, offset, content_range))
+        return None if total == '*' else int(total)
+
+    def download_iter(self, jobs, cache=True):
+        """
+            Download the files, up to workers at a time.
+
+            :param jobs: iterable of (url, filename)
+            :returns: iterator of (url, filename, error or None), in the same order as jobs
+        """
+        pool = ThreadPoolExecutor(max_workers=self.workers)
+        pending = deque()
+        try:
+            for url, filename in jobs:
+                pending.append((url, filename, pool.submit(self.download, url, filename, cache)))
+                while pending and (pending[0][2].done() or len(pending) > 2*self.workers):
+                    yield self._result(*pending.popleft())
+            while pending:
+                yield self._result(*pending.popleft())
+        finally:
+            for _, _, future in pending:
+                future.cancel()
+            pool.shutdown(wait=True)
+            self.save()
+
+    def _result(self, url, filename, future):
+        try:
+            future.result()
+            return (url, filename, None)
+        except Exception as e:
+            logging.debug("Download of %s failed" % url, exc_info=True)
+            return (url, filename, e)
+
+    def save(self):
+        """ Write the index back, dropping entries for files that no longer exist """
+        if not self.index_filename:
+            return
+        with self.lock:
+            sizes = dict((path, size) for path, size in self.sizes.items() if os.path.exists(path))
+            dirname = os.path.dirname(self.index_filename)
+            if dirname and not os.path.exists(dirname):
+                os.makedirs(dirname)
+            with open(self.index_filename + ".tmp", 'w') as f:
+                json.dump(sizes, f)
+            os.rename(self.index_filename + ".tmp", self.index_filename)
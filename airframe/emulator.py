@@ -0,0 +1,373 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright 2013 Virantha Ekanayake All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import argparse
+import sys, os
+import logging
+import cgi
+import random
+import threading
+import time
+import urlparse
+from collections import defaultdict
+from StringIO import StringIO
+
+import BaseHTTPServer
+import SocketServer
+
+from flashair import BULK_DELETE_SCRIPT
+
+
+class CardFile(object):
+    __slots__ = ('data', 'size', 'attributes', 'fat_date', 'fat_time')
+
+    def __init__(self, data, attributes=32, fat_date=0, fat_time=0, keep_data=True):
+        self.size = len(data) if data is not None else 0
+        self.data = data if keep_data else None
+        self.attributes = attributes
+        self.fat_date = fat_date
+        self.fat_time = fat_time
+
+
+class EmulatorHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+        Implements the parts of command.cgi and upload.cgi that airframe uses,
+        against the emulator's in-memory file system.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.emulator._count('connections')
+
+    def log_message(self, format, *args):
+        logging.debug("FlashAir emulator: " + format % args)
+
+    def _reply(self, code, body=""):
+        emulator = self.server.emulator
+        emulator._throttle(len(body))
+        self.send_response(code)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        emulator._count('bytes_sent', len(body))
+
+    def _read_body(self):
+        emulator = self.server.emulator
+        remaining = int(self.headers.get('Content-Length', 0))
+        chunks = []
+        while remaining > 0:
+            chunk = self.rfile.read(min(remaining, 64*1024))
+            if not chunk:
+                break
+            emulator._throttle(len(chunk))
+            chunks.append(chunk)
+            remaining -= len(chunk)
+        body = ''.join(chunks)
+        emulator._count('bytes_received', len(body))
+        return body
+
+    def _handle(self, method):
+        emulator = self.server.emulator
+        url = urlparse.urlsplit(self.path)
+        body = self._read_body() if method == 'POST' else ""
+        request = '%s %s' % (method, url.path)
+        emulator._count('requests')
+        emulator._count(request)
+
+        if not emulator._acquire():
+            emulator._count('rejected')
+            return self._reply(503, "BUSY")
+        try:
+            if emulator.latency:
+                time.sleep(emulator.latency)
+            if emulator._should_fail(request):
+                emulator._count('failures')
+                return self._reply(500, "ERROR")
+
+            if url.path == '/command.cgi':
+                return self._reply(*emulator.command(dict(urlparse.parse_qsl(url.query))))
+            if url.path == '/upload.cgi':
+                if method == 'POST':
+                    form = cgi.FieldStorage(fp=StringIO(body), headers=self.headers,
+                                            environ={'REQUEST_METHOD': 'POST',
+                                                     'CONTENT_TYPE': self.headers['Content-Type']})
+                    return self._reply(*emulator.upload(form['file'].filename, form['file'].value))
+                return self._reply(*emulator.upload_command(dict(urlparse.parse_qsl(url.query))))
+            if url.path == '/' + BULK_DELETE_SCRIPT:
+                return self._reply(*emulator.run_bulk_delete(urlparse.unquote(url.query)))
+            return self._reply(404, "NOT FOUND")
+        finally:
+            emulator._release()
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+
+class EmulatorServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class FlashAirEmulator(object):
+    """
+        A local stand-in for a FlashAir card's web server, so syncs can be
+        tested and benchmarked without a physical card.
+
+        The card is emulated with an in-memory file system, and the knobs
+        below make it behave more like the real (slow, fragile) thing.
+        Every request and byte is counted in ``stats``.
+    """
+    def __init__(self, latency=0.0, throughput=None, max_connections=None, failure_rate=0.0,
+                 seed=None, port=0, store_data=True):
+        """
+            :param latency: Seconds added to every request
+            :param throughput: Bytes per second the card can receive or send, or None for no limit
+            :param max_connections: Requests handled at once; any more get a 503, like a busy card
+            :param failure_rate: Fraction of requests answered with a 500 error
+            :param seed: Seed for the injected failures, to make them repeatable
+            :param port: Port to listen on, 0 for any free port
+            :param store_data: Keep the contents of uploaded photos, rather than
+                               just their sizes (turn off for big benchmarks)
+        """
+        self.latency = latency
+        self.throughput = throughput
+        self.max_connections = max_connections
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+        self.port = port
+        self.store_data = store_data
+
+        self.lock = threading.Lock()
+        self.throttle_lock = threading.Lock()
+        self.next_transfer = time.time()
+        self.active = 0
+        self.fail_count = 0
+        self.fail_request = None
+        self.stats = defaultdict(int)
+
+        self.dirs = {'/': {}, '/DCIM': {}, '/DCIM/100__TSB': {}}
+        self.upload_dir = '/'
+        self.fat32_time = 0
+        self.write_protect = False
+        self.updated = False
+        self.server = None
+        self.thread = None
+
+    # Server control
+
+    def start(self):
+        self.server = EmulatorServer(('127.0.0.1', self.port), EmulatorHandler)
+        self.server.emulator = self
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    @property
+    def hostname(self):
+        """ The host:port to give FlashAir """
+        return "127.0.0.1:%d" % self.port
+
+    def fail_next(self, count=1, request=None):
+        """
+            Answer the next count requests with a 500 error
+
+            :param request: Only fail requests like 'POST /upload.cgi', or any request if None
+        """
+        with self.lock:
+            self.fail_count += count
+            self.fail_request = request
+
+    def reset_stats(self):
+        with self.lock:
+            self.stats = defaultdict(int)
+
+    # File system
+
+    def _split(self, path):
+        path = '/' + path.strip('/')
+        directory, name = path.rsplit('/', 1)
+        return directory or '/', name
+
+    def add_file(self, path, data, fat_date=0, fat_time=0):
+        """ Put a file on the card as if the host device wrote it """
+        directory, name = self._split(path)
+        with self.lock:
+            self._mkdir(directory)
+            self.dirs[directory][name] = CardFile(data, 32, fat_date, fat_time)
+            self.updated = True
+
+    def files(self, directory='/DCIM/100__TSB'):
+        """
+            :returns: dict of filename to contents for the files in the directory
+        """
+        with self.lock:
+            return dict((name, f.data) for name, f in self.dirs.get(directory, {}).items() if not f.attributes & 16)
+
+    def _mkdir(self, directory):
+        if directory in self.dirs:
+            return
+        parent, name = self._split(directory)
+        self._mkdir(parent)
+        self.dirs[parent][name] = CardFile(None, 16)
+        self.dirs[directory] = {}
+
+    # Request handling, called with the lock released
+
+    def _count(self, key, n=1):
+        with self.lock:
+            self.stats[key] += n
+
+    def _acquire(self):
+        with self.lock:
+            if self.max_connections and self.active >= self.max_connections:
+                return False
+            self.active += 1
+            return True
+
+    def _release(self):
+        with self.lock:
+            self.active -= 1
+
+    def _should_fail(self, request):
+        with self.lock:
+            if self.fail_count and self.fail_request in (None, request):
+                self.fail_count -= 1
+                return True
+            return self.failure_rate and self.random.random() < self.failure_rate
+
+    def _throttle(self, nbytes):
+        # All connections share the card's radio
+        if not self.throughput or not nbytes:
+            return
+        with self.throttle_lock:
+            now = time.time()
+            start = max(now, self.next_transfer)
+            end = self.next_transfer = start + float(nbytes) / self.throughput
+        # Sleep until this transfer's own slot ends, not whichever was booked last
+        time.sleep(end - now)
+
+    def command(self, params):
+        op = params.get('op')
+        with self.lock:
+            if op == '100':
+                directory = '/' + params.get('DIR', '/').strip('/')
+                if directory not in self.dirs:
+                    return (404, "NOT FOUND")
+                lines = ["WLANSD_FILELIST"]
+                for name in sorted(self.dirs[directory]):
+                    f = self.dirs[directory][name]
+                    lines.append("%s,%s,%d,%d,%d,%d" % (directory.rstrip('/'), name, f.size, f.attributes,
+                                                        f.fat_date, f.fat_time))
+                return (200, "\r\n".join(lines) + "\r\n")
+            if op == '102':
+                updated, self.updated = self.updated, False
+                return (200, "1" if updated else "0")
+            if op == '108':
+                return (200, "F24A6W3AW1.00.03")
+        return (400, "ERROR")
+
+    def upload_command(self, params):
+        with self.lock:
+            if 'UPDIR' in params:
+                self.upload_dir = '/' + params['UPDIR'].strip('/')
+                self._mkdir(self.upload_dir)
+            elif 'FTIME' in params:
+                self.fat32_time = int(params['FTIME'], 16)
+            elif 'WRITEPROTECT' in params:
+                self.write_protect = params['WRITEPROTECT'] == 'ON'
+            elif 'DEL' in params:
+                directory, name = self._split(params['DEL'])
+                if name not in self.dirs.get(directory, {}):
+                    return (200, "ERROR")
+                del self.dirs[directory][name]
+                self.updated = True
+            else:
+                return (400, "ERROR")
+        return (200, "SUCCESS")
+
+    def upload(self, name, data):
+        with self.lock:
+            # Always keep files in the root, where the bulk delete lists go
+            self.dirs[self.upload_dir][name] = CardFile(data, 32, self.fat32_time >> 16, self.fat32_time & 0xFFFF,
+                                                        self.store_data or self.upload_dir == '/')
+            self.updated = True
+        return (200, "SUCCESS")
+
+    def run_bulk_delete(self, directory):
+        """ Does what the bulk delete Lua script would do on a real card """
+        with self.lock:
+            if BULK_DELETE_SCRIPT not in self.dirs['/']:
+                return (404, "NOT FOUND")
+            list_name = "AFDEL%s.TXT" % directory[-8:-5]
+            if list_name not in self.dirs['/']:
+                return (500, "lua error: cannot open list")
+            output = ["AIRFRAME_BULKDEL"]
+            for name in self.dirs['/'][list_name].data.splitlines():
+                name = name.strip()
+                if not name or '/' in name or '..' in name:
+                    continue
+                if name in self.dirs.get(directory, {}):
+                    del self.dirs[directory][name]
+                    output.append("DELETED " + name)
+                else:
+                    output.append("FAILED " + name)
+            del self.dirs['/'][list_name]
+            self.updated = True
+            output.append("DONE")
+        return (200, "\n".join(output) + "\n")
+
+
+def main():
+    p = argparse.ArgumentParser(description="Run a local FlashAir emulator for testing airframe")
+    p.add_argument('--port', type=int, default=8080)
+    p.add_argument('--latency', type=float, default=0.0, help='Seconds added to every request')
+    p.add_argument('--throughput', type=int, default=None, help='Bytes per second the card can transfer')
+    p.add_argument('--max-connections', type=int, default=None, help='Requests handled at once')
+    p.add_argument('--failure-rate', type=float, default=0.0, help='Fraction of requests that fail')
+    args = p.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG, format='%(message)s')
+    emulator = FlashAirEmulator(args.latency, args.throughput, args.max_connections, args.failure_rate,
+                                port=args.port)
+    emulator.start()
+    print("FlashAir emulator listening on %s" % emulator.hostname)
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        emulator.stop()
+
+
+if __name__ == '__main__':
+    main()
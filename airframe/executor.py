@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright 2013 Virantha Ekanayake All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import logging
+import threading
+import time
+from collections import deque, namedtuple
+
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+CardOperation = namedtuple('CardOperation', ['kind', 'name', 'func', 'size'])
+OperationTiming = namedtuple('OperationTiming', ['kind', 'name', 'size', 'seconds', 'workers', 'ok'])
+
+class CardExecutor(object):
+    """
+        Runs delete/upload operations against a FlashAir card with a small,
+        bounded number of requests in flight.
+
+        The card's web server is easily overwhelmed, so the executor drops back
+        to running one operation at a time as soon as the card returns an
+        error or requests start taking much longer than they did at first.
+        Failed operations are retried once serially.
+    """
+    def __init__(self, workers=1, slowdown_factor=3.0, window=4):
+        """
+            :param workers: Maximum number of operations in flight
+            :param slowdown_factor: Drop to serial when the recent average time per
+                                    operation grows by this factor over the best seen
+            :param window: Number of recent operations used for the slowdown average
+        """
+        self.workers = max(1, workers)
+        self.max_workers = self.workers
+        self.slowdown_factor = slowdown_factor
+        self.window = window
+        self.timings = []
+        self.lock = threading.Lock()
+        self.recent = {}
+        self.best = {}
+
+    def degrade(self, reason):
+        if self.workers > 1:
+            print("FlashAir: %s, dropping back to serial requests" % reason)
+            self.workers = 1
+
+    def _cost(self, timing):
+        # Normalize uploads by their size so large files don't look like a slowdown
+        if timing.size:
+            return timing.seconds / timing.size
+        return timing.seconds
+
+    def _record(self, timing):
+        with self.lock:
+            self.timings.append(timing)
+            if not timing.ok:
+                return
+            recent = self.recent.setdefault(timing.kind, deque(maxlen=self.window))
+            recent.append(self._cost(timing))
+            if len(recent) < self.window:
+                return
+            average = sum(recent) / len(recent)
+            best = self.best.get(timing.kind)
+            if best is None or average < best:
+                self.best[timing.kind] = average
+            elif average > best * self.slowdown_factor:
+                self.degrade("card slowed down")
+
+    def _run_op(self, op):
+        workers = self.workers
+        start = time.time()
+        ok = False
+        try:
+            op.func()
+            ok = True
+        finally:
+            self._record(OperationTiming(op.kind, op.name, op.size, time.time()-start, workers, ok))
+
+    def run(self, operations):
+        """
+            Run all the operations, returning once every one has completed.
+
+            :param operations: iterable of CardOperation
+            :raises: the exception from any operation that also fails its serial retry
+        """
+        pending = deque(operations)
+        retries = []
+
+        if self.workers > 1 and len(pending) > 1:
+            pool = ThreadPoolExecutor(max_workers=self.workers)
+            in_flight = {}
+            try:
+                while pending or in_flight:
+                    while pending and len(in_flight) < self.workers:
+                        op = pending.popleft()
+                        in_flight[pool.submit(self._run_op, op)] = op
+                    done, _ = wait(list(in_flight), return_when=FIRST_COMPLETED)
+                    for future in done:
+                        op = in_flight.pop(future)
+                        try:
+                            future.result()
+                        except Exception as e:
+                            logging.debug("%s %s failed: %s" % (op.kind, op.name, e))
+                            self.degrade("card returned an error")
+                            retries.append(op)
+            finally:
+                pool.shutdown(wait=True)
+
+        for op in retries + list(pending):
+            self._run_op(op)
+
+    def report(self):
+        """
+            Print the per-operation timing summary, so different --card-workers
+            settings can be compared for a given card.
+        """
+        kinds = []
+        for timing in self.timings:
+            if timing.kind not in kinds:
+                kinds.append(timing.kind)
+        for kind in kinds:
+            timings = [t for t in self.timings if t.kind == kind and t.ok]
+            failed = len([t for t in self.timings if t.kind == kind and not t.ok])
+            if not timings:
+                print("FlashAir %s: %d failed" % (kind, failed))
+                continue
+            total = sum(t.seconds for t in timings)
+            size = sum(t.size for t in timings)
+            line = "FlashAir %s: %d ok, %d failed, %.3fs avg, %.3fs max (workers: %d)" % (
+                    kind, len(timings), failed, total/len(timings),
+                    max(t.seconds for t in timings), self.max_workers)
+            if size:
+                line += ", %.1f KB/s per request" % (size / 1024.0 / max(total, 1e-6))
+            print(line)
+            for t in timings:
+                logging.debug("%s %s: %d bytes in %.3fs with %d workers" % (t.kind, t.name, t.size, t.seconds, t.workers))
@@ -18,36 +18,110 @@ import argparse
 import sys, os
 import logging
 
+import json
 import yaml
 import facebook
-import urllib
+import requests
 import urlparse
 from operator import itemgetter
+from requests.adapters import HTTPAdapter
+
+from download import Downloader
+from imaging import pick_size
+from pipeline import PhotoStream
 
 
 SAFE_CHARS = '-_() abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789'
 
+GRAPH_URL = "https://graph.facebook.com/"
+# The most photos the Graph API returns in one page
+PAGE_SIZE = 100
+# Pages fetched with each batch request (the Graph API allows up to 50)
+PAGES_PER_BATCH = 10
+
 class Photo(object):
     def __init__(self, photo_element):
         """Construct a photo object out of the JSON response from Facebook"""
-        attrs = { 'source': 'source', 'photoid':'photoid'}
+        attrs = { 'source': 'source', 'photoid':'photoid', 'width': 'width'}
         for fb_attr, py_attr in attrs.items():
             setattr(self, fb_attr, photo_element.get(fb_attr))
 
-    def download_photo(self, dirname, cache=False, tgt_filename=None):
-        if not os.path.exists(dirname):
-            os.makedirs(dirname)
-        tgt = os.path.join(dirname, "%s.jpg" % self.photoid)
-        if cache:
-            if os.path.isfile(tgt):
-                return tgt
-        urllib.urlretrieve(self.source, tgt)
-        return tgt
+    def filename(self, dirname):
+        # Each size is cached separately, so changing the box never reuses a smaller download
+        if self.width:
+            return os.path.join(dirname, "%s_%d.jpg" % (self.photoid, self.width))
+        return os.path.join(dirname, "%s.jpg" % self.photoid)
+
+    def download_photo(self, dirname, cache=False, tgt_filename=None, downloader=None):
+        """
+            :type downloader: Downloader
+        """
+        downloader = downloader or Downloader(workers=1)
+        return downloader.download(self.source, self.filename(dirname), cache)
         
+class GraphClient(object):
+    """
+        The parts of the Graph API airframe uses, over one pooled keep-alive
+        session.  Several pages of a listing can be fetched with a single
+        batch request.
+    """
+    def __init__(self, access_token=None, session=None, connect_timeout=10.0, read_timeout=60.0):
+        """
+            :param session: Optional pre-configured session to use instead of creating one
+            :type session: requests.Session
+        """
+        self.access_token = access_token
+        self.timeout = (connect_timeout, read_timeout)
+        if session is None:
+            session = requests.Session()
+            session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=4))
+        self.session = session
+
+    def _check(self, result):
+        if isinstance(result, dict) and result.get('error'):
+            raise facebook.GraphAPIError(result)
+        return result
+
+    def _json(self, r):
+        try:
+            return self._check(r.json())
+        except ValueError:
+            r.raise_for_status()
+            raise facebook.GraphAPIError({'error': {'message': "Unexpected response: %s" % r.text[:200]}})
+
+    def batch(self, relative_urls):
+        """
+            Make several GET requests in one round trip.
+
+            :param relative_urls: paths with their query strings, e.g. me/photos?limit=10
+            :returns: list of the decoded response to each request, in order
+            :raises: facebook.GraphAPIError if any of them failed, or requests.RequestException
+        """
+        batch = [{'method': 'GET', 'relative_url': url} for url in relative_urls]
+        r = self.session.post(GRAPH_URL, data={'access_token': self.access_token, 'batch': json.dumps(batch)},
+                              timeout=self.timeout)
+        results = []
+        for url, result in zip(relative_urls, self._json(r)):
+            if result is None:
+                raise facebook.GraphAPIError({'error': {'message': "Batch request for %s timed out" % url}})
+            results.append(self._check(json.loads(result['body'])))
+        return results
+
+
 class FacebookPhotos(object):
 
-    def __init__(self):
+    def __init__(self, box=None, downloader=None):
+        """
+            :param box: (width, height) the photos will be resized to fit, so
+                        the smallest image that fills it can be downloaded
+            :param downloader: Downloads the photos, defaults to 4 at a time
+            :type downloader: Downloader
+        """
+        self.box = box
+        self.downloader = downloader or Downloader()
         self.set_keys(*self.read_keys())
+        # Graph requests share the downloads' connection pool
+        self.graph = GraphClient(self.access_token, session=self.downloader.session)
         self.refresh_token()
 
     def read_keys(self):
@@ -71,40 +145,46 @@ class FacebookPhotos(object):
             outfile.close()
  
     def refresh_token(self):
-        new_token = None
         """
             Gets a new long-lived token using the current long-lived token.
             See http://nodotcom.org/python-facebook-tutorial.html for reference.
         """
-        url = 'https://graph.facebook.com/oauth/access_token?client_id=%s&client_secret=%s&grant_type=fb_exchange_token&fb_exchange_token=%s' % (self.app_id, self.app_secret, self.access_token)
-        response = urllib.urlopen(url)
-        oauth = response.read()
+        params = {'client_id': self.app_id, 'client_secret': self.app_secret,
+                  'grant_type': 'fb_exchange_token', 'fb_exchange_token': self.access_token}
         try:
-            new_token = urlparse.parse_qs(oauth)['access_token'][0]
-            self.access_token = new_token
-            self.write_keys()
-        except:
+            r = self.graph.session.get(GRAPH_URL + 'oauth/access_token', params=params, timeout=self.graph.timeout)
+            try:
+                new_token = r.json()['access_token']
+            except ValueError:
+                # Older API versions answer with a query string
+                new_token = urlparse.parse_qs(r.text)['access_token'][0]
+        except (requests.RequestException, KeyError, IndexError, TypeError) as e:
+            logging.debug("Token refresh failed: %s" % e)
             print 'Failed to retrieve and store a new long-lived token.'
-        response.close()
+            return
+        self.access_token = new_token
+        self.graph.access_token = new_token
+        self.write_keys()
 
-    def _sync_photos(self, photos, download_dir="photos", clean_up=False):
+    def _sync_photos(self, photos, download_dir="photos", clean_up=False, stream=False):
         """
             Connect to Facebook, and for each photo in the list, download.
             Then, if deleted photos that are present locally that weren't present in the list of photos.
 
             :returns: List of filenames downloaded
         """
-        photo_filenames = []
-        photo_count = len(photos)
-        for i,photo in enumerate(photos):
-            print("[%d/%d] Downloading %s from Facebook" % (i+1, photo_count, photo.photoid))
-            filename = photo.download_photo(download_dir, cache=True)
-            photo_filenames.append(filename)
+        if stream or clean_up:
+            # The full list is needed up front
+            photos = list(photos)
+        if stream:
+            return PhotoStream([x.filename(download_dir) for x in photos],
+                               self._download_photos(photos, download_dir))
+        photo_filenames = list(self._download_photos(photos, download_dir))
 
         # Now, go through and clean up directory if required
         
         if clean_up:
-            photo_file_list = ["%s.jpg" % (x.photoid) for x in photos]
+            photo_file_list = [os.path.basename(x.filename(download_dir)) for x in photos]
             for fn in os.listdir(download_dir):
                 full_fn = os.path.join(download_dir, fn)
                 if os.path.isfile(full_fn):
@@ -114,6 +194,23 @@ class FacebookPhotos(object):
 
         return photo_filenames
 
+    def _download_photos(self, photos, download_dir):
+        """
+            Download the photos concurrently, skipping any that fail.
+
+            :returns: iterator of the downloaded filenames, in the same order as photos
+        """
+        # A listing still being fetched doesn't know how many photos it has
+        photo_count = len(photos) if hasattr(photos, '__len__') else None
+        jobs = ((photo.source, photo.filename(download_dir)) for photo in photos)
+        for i, (url, filename, error) in enumerate(self.downloader.download_iter(jobs, cache=True)):
+            progress = "%d/%d" % (i+1, photo_count) if photo_count else "%d" % (i+1)
+            if error:
+                print("[%s] Could not download %s from Facebook, skipping it: %s" % (progress, url, error))
+                continue
+            print("[%s] Downloaded %s from Facebook" % (progress, os.path.basename(filename)))
+            yield filename
+
     def _extract_photos_from_json(self, dat):
         """Extract required data from a row"""
         err = []
@@ -124,15 +221,14 @@ class FacebookPhotos(object):
                 continue
             photoid = d['id']
             
-            if 'source' not in d:
-                err.append(d)
-                continue
-            source = d['source']
-            
-            if 'images' not in d:
+            if not d.get('images'):
                 err.append(d)
                 continue
             images = d['images']
+            if self.box:
+                width, height, source = pick_size([(i['width'], i['height'], i['source']) for i in images], self.box)
+                photos.append(Photo({'source': source, 'photoid': photoid, 'width': width}))
+                continue
             images.sort(key=itemgetter('width'), reverse=True)
             photos.append(Photo({'source': images[0]['source'], 'photoid': photoid}))
         if err:
@@ -140,32 +236,40 @@ class FacebookPhotos(object):
             print err
         return photos
 
-    def get_recent(self, count, download_dir="photos"):
-        depth=10
-        
-        """Fetch the data using Facebook's Graph API"""
-        photo_filenames = []
-        graph = facebook.GraphAPI(self.access_token)
-        url = 'me/photos/uploaded'
-#        url = 'me/photos/'
-        photos = []
+    def list_photos(self, count, path='me/photos/uploaded'):
+        """
+            List up to count photos, fetching PAGES_PER_BATCH pages with each
+            request to the Graph API, and producing the photos as they arrive
+            so the downloads can start while later pages are fetched.
 
-        args = {'fields': ['source', 'photoid', 'images'], 'limit': count}
-        res = graph.request(url, args)
-        photos.extend(self._extract_photos_from_json(res['data']))
-    
-        # continue fetching till all photos are found
-        for _ in xrange(depth):
-            if 'paging' not in res:
-                break
-            try:
-                url = res['paging']['next']
-                res = json.loads(urllib.urlopen(url).read())
-                photos.extend(self._extract_photos_from_json(res['data']))
-            except:
-                break
-            
-        photo_filenames = self._sync_photos(photos, download_dir)
+            :returns: iterator of Photo
+        """
+        limit = min(count, PAGE_SIZE)
+        listed = 0
+        offset = 0
+        seen = set()
+        while listed < count:
+            pages = min(PAGES_PER_BATCH, (count - listed + limit - 1) // limit)
+            urls = ["%s?fields=id,images&limit=%d&offset=%d" % (path, limit, offset + i*limit) for i in range(pages)]
+            offset += pages * limit
+            for page in self.graph.batch(urls):
+                data = page.get('data', [])
+                for photo in self._extract_photos_from_json(data):
+                    # Photos can move to the next page while we are listing
+                    if listed < count and photo.photoid not in seen:
+                        seen.add(photo.photoid)
+                        listed += 1
+                        yield photo
+                # Pages can come back short when photos are filtered out for
+                # privacy, so only a missing next page ends the listing
+                if not data or 'next' not in page.get('paging', {}):
+                    return
+
+    def get_recent(self, count, download_dir="photos", stream=False):
+        """Fetch the data using Facebook's Graph API"""
+        photos = self.list_photos(count)
+#        photos = self.list_photos(count, 'me/photos')
+        photo_filenames = self._sync_photos(photos, download_dir, stream=stream)
         return photo_filenames
 
 def main():
@@ -16,9 +16,50 @@
 import sys, os, shutil
 import logging
 import requests
+from requests.adapters import HTTPAdapter
 
 import hashlib
 import time
+import datetime
+import json
+import zlib
+import tempfile
+import threading
+
+from executor import CardExecutor, CardOperation
+from multipart import MultipartFileStream, RateLimiter, TransferProgress
+from syncplan import plan_sync
+from naming import ContentNamer
+from timing import StageTimer
+
+BULK_DELETE_SCRIPT = "AIRFRAME.LUA"
+
+# Ready files gathered per directory before a streaming sync uploads them, so
+# that spreading photos across directories doesn't mean an UPDIR per photo
+STREAM_SHARD_BATCH = 4
+
+# Deletes the files named in a list file from the directory passed as the
+# script argument, reporting each one back so failures can be retried.
+BULK_DELETE_LUA = """-- airframe bulk delete helper
+local dir = arg[1]
+local list = "/AFDEL" .. string.sub(dir, -8, -6) .. ".TXT"
+print("HTTP/1.1 200 OK")
+print("Content-Type: text/plain")
+print("")
+print("AIRFRAME_BULKDEL")
+for name in io.lines(list) do
+  name = string.gsub(name, "%s+$", "")
+  if name ~= "" and not string.find(name, "/") and not string.find(name, "%.%.") then
+    if os.remove(dir .. "/" .. name) then
+      print("DELETED " .. name)
+    else
+      print("FAILED " .. name)
+    end
+  end
+end
+os.remove(list)
+print("DONE")
+"""
 
 class FlashAir(object):
     """
@@ -26,19 +67,84 @@ class FlashAir(object):
         See the documentation to their API at:
             https://flashair-developers.com/en/
     """
-    def __init__(self, hostname):
+    def __init__(self, hostname, session=None, connect_timeout=5.0, read_timeout=30.0, workers=1,
+                 max_kbps=None, chunk_size=64*1024, manifest_dir=None,
+                 hasher=None, shards=1, shard_cap=1000, bulk_delete=False,
+                 timer=None):
         """ 
+            All traffic to the card goes through a single keep-alive session, so
+            a sync reuses one TCP connection instead of opening a new one for
+            every command.
+
             :param hostname: IP address or hostname of the FlashAir card
             :type hostname: string
+            :param session: Optional pre-configured session to use instead of creating one
+            :type session: requests.Session
+            :param connect_timeout: Seconds to wait for a connection to the card
+            :param read_timeout: Seconds to wait for the card to respond to a request
+            :param workers: Maximum number of deletes/uploads to keep in flight during a sync
+            :param max_kbps: Cap on the combined upload rate in kilobits per second
+            :param chunk_size: Bytes of each file read and sent at a time when uploading
+            :param manifest_dir: Directory to keep a manifest of the card's files
+                                 between syncs, so unchanged cards needn't be listed again
+            :param hasher: If given, name files on the card by a hash of their
+                           contents instead of their local filename
+            :type hasher: ContentHasher
+            :param shards: Number of DCF-style directories (100__TSB, 101__TSB, ...)
+                           to spread the photos across
+            :param shard_cap: Maximum number of photos per directory when sharding
+            :param bulk_delete: Delete stale files with a Lua script run on the card,
+                                one request per directory instead of one per file
+            :param timer: StageTimer to record the time spent in each stage of a sync
         """
         self.hostname = hostname
+        self.card_root = "/DCIM"
         self.card_path = "/DCIM/100__TSB"
+        self.shards = shards
+        self.shard_cap = shard_cap
+        self.shard_dirs = ["%s/%d__TSB" % (self.card_root, 100+i) for i in range(shards)]
+        self.timeout = (connect_timeout, read_timeout)
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.rate_limiter = RateLimiter(max_kbps) if max_kbps else None
+        self.progress = TransferProgress()
+        self.manifest_dir = manifest_dir
+        self.content_namer = ContentNamer(hasher) if hasher else None
+        self.bulk_delete = bulk_delete
+        # The upload timestamp is sticky on the card, whichever directory it is for
+        self.fat32_time = None
+        self.bulk_delete_ready = False
+        self.timer = timer or StageTimer()
+        if session is None:
+            session = self._create_session(pool_size=workers)
+        self.session = session
+
+    def _create_session(self, pool_size=1):
+        """
+            The card's embedded web server only handles a handful of connections,
+            so keep a small pool and ask it to keep them alive.
+        """
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        session.mount("http://", adapter)
+        session.headers.update({'Connection': 'keep-alive'})
+        return session
+
+    def _get(self, cgi, params):
+        r = self.session.get("http://%s/%s" % (self.hostname, cgi), params=params, timeout=self.timeout)
+        r.raise_for_status()
+        return r
 
-    def delete_file(self, filename):
-        payload = {"op":100, "DIR":self.card_path}
-        r = requests.get("http://%s/command.cgi" % self.hostname, params=payload)
+    def _post(self, cgi, **kwargs):
+        r = self.session.post("http://%s/%s" % (self.hostname, cgi), timeout=self.timeout, **kwargs)
+        r.raise_for_status()
+        return r
 
-    def get_file_list(self):
+    def close(self):
+        """ Release the pooled connections to the card """
+        self.session.close()
+
+    def _list_dir(self, card_path):
         """
 
             The SD card returns a list that looks like the following:
@@ -50,25 +156,210 @@ class FlashAir(object):
             /DCIM/100__TSB,FLASH6.JPG,387163,32,17295,31508
             /DCIM/100__TSB,FLASH7.JPG,533998,32,17295,31520
 
+            The columns are the directory, filename, size in bytes, attribute
+            bits, and the FAT date and time.
+
+            :returns: list of CardEntry for the directory, empty if it doesn't exist
         """
-        payload = {"op":100, "DIR":self.card_path}
-        r = requests.get("http://%s/command.cgi" % self.hostname, params=payload)
-        r.raise_for_status()
+        payload = {"op":100, "DIR":card_path}
+        try:
+            r = self._get("command.cgi", payload)
+        except requests.HTTPError as e:
+            if e.response is not None and e.response.status_code == 404:
+                return []
+            raise
         logging.debug("Response: %s" % r.text)
         # Divide the returned text by newline, and ignore the first line "WLANSD_FILELIST"
         lines = r.text.split('\n')
         assert lines[0].strip()=='WLANSD_FILELIST'
 
-        filenames = []
+        entries = []
         for line in lines[1:]:
-            # Split each line by ',' and take the second column for the filename
-            values = line.split(',')
-            if len(values) > 2:
-                filename = values[1].strip()
-                filenames.append(filename)
+            entry = CardEntry.from_line(line)
+            if entry:
+                entries.append(entry)
+        return entries
+
+    def get_file_index(self, card_path=None):
+        """
+            :param card_path: Directory to list, defaults to card_path
+            :returns: dict of filename to CardEntry for every file (not
+                      sub-directory) in the directory
+        """
+        index = {}
+        for entry in self._list_dir(card_path or self.card_path):
+            if not entry.is_dir:
+                index[entry.name] = entry
 
-        logging.debug("File names: %s" % filenames)
-        return filenames
+        logging.debug("File names: %s" % sorted(index))
+        return index
+
+    def get_stale_shard_dirs(self):
+        """
+            Only directories airframe recorded syncing into are returned, so
+            other DCF directories on the card are never touched.
+
+            :returns: shard directories left on the card from a sync that used more shards
+        """
+        return [card_path for card_path in self.load_shard_dirs() if card_path not in self.shard_dirs]
+
+    def _shard_record_filename(self):
+        name = "flashair_%s_shards.json" % self.hostname
+        return os.path.join(self.manifest_dir, name.replace('/', '_').replace(':', '_'))
+
+    def _save_emptied_shard_dirs(self, sd_file_indexes):
+        """ Forget the leftover directories this sync listed, and so emptied """
+        self.save_shard_dirs(self.shard_dirs + [card_path for card_path in self.get_stale_shard_dirs()
+                                                if card_path not in sd_file_indexes])
+
+    def load_shard_dirs(self):
+        """
+            :returns: the directories earlier syncs put photos in, besides card_path
+        """
+        if not self.manifest_dir or not os.path.isfile(self._shard_record_filename()):
+            return []
+        try:
+            with open(self._shard_record_filename()) as f:
+                return json.load(f)['shard_dirs']
+        except (ValueError, KeyError):
+            logging.debug("Ignoring unreadable shard record %s" % self._shard_record_filename())
+            return []
+
+    def save_shard_dirs(self, shard_dirs):
+        """
+            Record the directories that hold airframe's photos, so they can
+            be emptied if a later sync uses fewer of them.
+        """
+        if not self.manifest_dir:
+            return
+        filename = self._shard_record_filename()
+        shard_dirs = sorted(set(shard_dirs) - set([self.card_path]))
+        if not shard_dirs:
+            if os.path.isfile(filename):
+                os.remove(filename)
+            return
+        if not os.path.exists(self.manifest_dir):
+            os.makedirs(self.manifest_dir)
+        with open(filename + ".tmp", 'w') as f:
+            json.dump({'hostname': self.hostname, 'shard_dirs': shard_dirs}, f)
+        os.rename(filename + ".tmp", filename)
+
+    def is_card_updated(self):
+        """
+            Ask the card whether its file system changed since the last time
+            this was asked (op=102).  Reading the status also resets it.
+
+            :returns: False only if the card reports it hasn't been updated
+        """
+        r = self._get("command.cgi", {"op":102})
+        return r.text.strip() != "0"
+
+    def _manifest_filename(self, card_path=None):
+        name = "flashair_%s_%s.json" % (self.hostname, (card_path or self.card_path).strip('/'))
+        return os.path.join(self.manifest_dir, name.replace('/', '_').replace(':', '_'))
+
+    def load_manifest(self, card_path=None):
+        """
+            :returns: the file index saved by the last sync, or None if there
+                      isn't one for the current number of shards
+        """
+        filename = self._manifest_filename(card_path)
+        if not os.path.isfile(filename):
+            return None
+        try:
+            with open(filename) as f:
+                manifest = json.load(f)
+        except ValueError:
+            logging.debug("Ignoring unreadable manifest %s" % filename)
+            return None
+        if manifest.get('shards', 1) != self.shards:
+            return None
+        index = {}
+        for line in manifest['entries']:
+            entry = CardEntry.from_line(line)
+            index[entry.name] = entry
+        return index
+
+    def save_manifest(self, index, card_path=None):
+        """
+            :param index: dict of filename to CardEntry for the files now on the card
+        """
+        if not os.path.exists(self.manifest_dir):
+            os.makedirs(self.manifest_dir)
+        filename = self._manifest_filename(card_path)
+        with open(filename + ".tmp", 'w') as f:
+            json.dump({'hostname': self.hostname, 'card_path': card_path or self.card_path, 'shards': self.shards,
+                       'entries': [index[fn].to_line() for fn in sorted(index)]}, f, indent=0)
+        os.rename(filename + ".tmp", filename)
+
+    def invalidate_manifest(self, card_path=None):
+        """ Remove the manifest before changing the card, in case the sync doesn't finish """
+        if self.manifest_dir and os.path.isfile(self._manifest_filename(card_path)):
+            os.remove(self._manifest_filename(card_path))
+
+    def get_cached_file_indexes(self):
+        """
+            Use the manifests from the last sync instead of listing the card,
+            if the card reports it hasn't changed since then.
+
+            :returns: dict of shard directory to a dict of filename to CardEntry
+        """
+        if self.manifest_dir:
+            indexes = dict((card_path, self.load_manifest(card_path)) for card_path in self.shard_dirs)
+            if None not in indexes.values() and not self.is_card_updated():
+                logging.debug("Card unchanged since last sync, using manifest")
+                return indexes
+
+        indexes = dict((card_path, self.get_file_index(card_path)) for card_path in self.shard_dirs)
+        # Even with one directory, an earlier sync may have used more
+        for card_path in self.get_stale_shard_dirs():
+            indexes[card_path] = self.get_file_index(card_path)
+        return indexes
+
+    def assign_shards(self, filename_list):
+        """
+            Spread the files across the shard directories.  Each file goes to
+            the directory picked by a hash of its card name, or if that one is
+            full, the next one with room, so the assignment is stable as long
+            as the directories have room.
+
+            :returns: dict of shard directory to the list of local files in it
+        """
+        assignment = dict((card_path, []) for card_path in self.shard_dirs)
+        if self.shards == 1:
+            assignment[self.card_path] = list(filename_list)
+            return assignment
+
+        if len(filename_list) > self.shards * self.shard_cap:
+            raise ValueError("%d photos do not fit in %d directories of %d" % (len(filename_list), self.shards, self.shard_cap))
+
+        named = sorted((self.card_name(fn), i, fn) for i, fn in enumerate(filename_list))
+        shard_of = {}
+        counts = [0] * self.shards
+        overflow = []
+        for name, i, fn in named:
+            shard = (zlib.crc32(name) & 0xffffffff) % self.shards
+            if counts[shard] < self.shard_cap:
+                counts[shard] += 1
+                shard_of[i] = shard
+            else:
+                overflow.append((name, i, fn, shard))
+        for name, i, fn, shard in overflow:
+            while counts[shard] >= self.shard_cap:
+                shard = (shard + 1) % self.shards
+            counts[shard] += 1
+            shard_of[i] = shard
+
+        # Keep the files in their original order within each directory
+        for i, fn in enumerate(filename_list):
+            assignment[self.shard_dirs[shard_of[i]]].append(fn)
+        return assignment
+
+    def get_file_list(self):
+        """
+            :returns: list of the filenames in the card_path directory
+        """
+        return sorted(self.get_file_index())
 
     def _get_renamed_filename(self, filename):
         # First, separate out the path from the filename
@@ -79,9 +370,17 @@ class FlashAir(object):
         hash_filename = "%s.JPG" % (h.hexdigest()[:8].upper())
 
         hash_full_filename = os.path.join(path, hash_filename)
-        logging.debug("Hashed file: %s" % (hash_full_filename))
+        logging.debug("Hashed file: %s", hash_full_filename)
         return hash_full_filename
 
+    def card_name(self, filename):
+        """
+            :returns: the 8.3 filename the local file is stored under on the card
+        """
+        if self.content_namer:
+            return self.content_namer(filename)
+        return os.path.basename(self._get_renamed_filename(filename))
+
 
     def copy_and_rename_file(self, filename):
         """
@@ -103,94 +402,491 @@ class FlashAir(object):
         os.chdir(cwd)
         return hash_full_filename
 
-    def delete_file(self, filename):
-        # Change the upload directory on the card
-        url = "http://%s/upload.cgi" % self.hostname
+    def delete_file(self, filename, card_path=None):
+        payload = {'DEL': "%s/%s" % (card_path or self.card_path, filename)}
+        self._get("upload.cgi", payload)
+
+    def _upload_data(self, card_path, card_name, data):
+        """ Upload a string as a file on the card """
+        fd, path = tempfile.mkstemp()
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            with self.upload_session(write_protect=False, card_path=card_path) as session:
+                session.upload(path, card_name=card_name)
+        finally:
+            os.remove(path)
+
+    def install_bulk_delete_script(self):
+        """
+            Copy the bulk delete Lua script to the root of the card, unless
+            it's already there.
+        """
+        if self.bulk_delete_ready:
+            return
+        installed = dict((entry.name, entry) for entry in self._list_dir("/"))
+        entry = installed.get(BULK_DELETE_SCRIPT)
+        if entry is None or entry.size != len(BULK_DELETE_LUA):
+            logging.debug("Installing %s on the card" % BULK_DELETE_SCRIPT)
+            self._upload_data("/", BULK_DELETE_SCRIPT, BULK_DELETE_LUA)
+        self.bulk_delete_ready = True
+
+    def delete_files(self, filenames, card_path=None):
+        """
+            Delete a batch of files from a directory on the card in a single
+            request, by uploading the list of names and running the bulk
+            delete script on the card against it.
+
+            :returns: the filenames the script did not delete
+        """
+        card_path = card_path or self.card_path
+        self.install_bulk_delete_script()
+        # One list file per shard directory, named after its number (100__TSB -> AFDEL100.TXT)
+        self._upload_data("/", "AFDEL%s.TXT" % card_path[-8:-5], "\n".join(filenames) + "\n")
 
-        payload = {'DEL': "%s/%s" % (self.card_path, filename)}
-        r = requests.get(url, params=payload)
+        r = self.session.get("http://%s/%s?%s" % (self.hostname, BULK_DELETE_SCRIPT, card_path), timeout=self.timeout)
         r.raise_for_status()
+        lines = [line.strip() for line in r.text.split('\n')]
+        if "AIRFRAME_BULKDEL" not in lines:
+            raise IOError("Bulk delete script did not run on the card")
+        deleted = set(line[len("DELETED "):] for line in lines if line.startswith("DELETED "))
+        remaining = [fn for fn in filenames if fn not in deleted]
+        if "DONE" not in lines:
+            logging.debug("Bulk delete script stopped early, %d files left" % len(remaining))
+        return remaining
+
+    def _bulk_delete(self, card_path, filenames):
+        """
+            :returns: files still to delete one at a time, all of them if the
+                      bulk delete script couldn't be used
+        """
+        print("Deleting %d files in %s on FlashAir" % (len(filenames), card_path))
+        try:
+            return self.delete_files(filenames, card_path)
+        except (IOError, requests.RequestException) as e:
+            print("FlashAir bulk delete failed (%s), deleting files one at a time" % e)
+            self.bulk_delete = False
+            return filenames
 
     def _set_write_protect(self):
-        # Change the upload directory on the card
-        url = "http://%s/upload.cgi" % self.hostname
-
         payload = {'WRITEPROTECT': "ON"}
-        r = requests.get(url, params=payload)
-        r.raise_for_status()
+        r = self._get("upload.cgi", payload)
         if not "SUCCESS" in r.content:
             print("Could not put card into host-write-protect mode")
 
 
+    def _fat32_time(self, t):
+        return ((t.tm_year-1980)<<25) | (t.tm_mon << 21) | (t.tm_mday << 16) | (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec >>1)
+
     def set_timestamp(self, t):
         """
             :param t: The time stamp
             :type t: time.struct_time
         """
-        fat32_time = ((t.tm_year-1980)<<25) | (t.tm_mon << 21) | (t.tm_mday << 16) | (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec >>1)
+        fat32_time = self._fat32_time(t)
 
         #print("Setting timestamp to %d (0x%0.8X)" % (fat32_time, fat32_time))
-        url = "http://%s/upload.cgi" % self.hostname
         payload = {'FTIME': "0x%0.8X" % fat32_time}
-        r = requests.get(url, params=payload)
-        r.raise_for_status()
+        self._get("upload.cgi", payload)
+        self.fat32_time = fat32_time
 
-    def upload_file(self, filename):
-        # First, set the time of the photo to right now
-        self.set_timestamp(time.localtime())
-        # Change the upload directory on the card
-        url = "http://%s/upload.cgi" % self.hostname
+    def set_upload_dir(self, card_path):
+        payload = {'UPDIR':card_path}
+        self._get("upload.cgi", payload)
 
-        payload = {'UPDIR':self.card_path}
-        r = requests.get(url, params=payload)
-        r.raise_for_status()
+    def upload_session(self, write_protect=True, card_path=None):
+        """
+            :param card_path: Directory to upload to, defaults to card_path
+            :returns: an UploadSession that uploads into the directory
+        """
+        return UploadSession(self, card_path or self.card_path, write_protect)
 
-        # Now, upload the file
-        hash_full_filename = self._get_renamed_filename(filename)
-        hash_filename = os.path.basename(hash_full_filename)
+    def upload_file(self, filename, card_name=None, card_path=None):
+        """
+            Upload a single file.  Use :meth:`upload_session` when uploading
+            more than one file so the card setup is only done once.
+        """
+        with self.upload_session(write_protect=False, card_path=card_path) as session:
+            session.upload(filename, card_name=card_name)
 
-        files = {'file':(hash_filename, open(filename,'rb'))}
-        r = requests.post(url, files=files)
-        r.raise_for_status()
-        
-    def sync_files_on_card_to_list(self, filename_list, force=False):
+    def sync_files_on_card_to_list(self, filename_list, force=False, batch_uploads=True):
         """
             Delete any files on the SD card that are not present in the list.
-            Upload any files not already present on the card (based on name).
+            Upload any files not already present on the card (based on name
+            and size, so truncated uploads are replaced).
             Ignore any files already present on the card.
+
+            :param batch_uploads: Set up the card once and send all the uploads
+                                  through one UploadSession, instead of
+                                  configuring the card again before every file
         """
 
-        self._set_write_protect()
+        timer = self.timer
+        # Uploads are stamped with the time this sync started
+        self.fat32_time = None
         # First, get the file list on the card
-        sd_file_list = self.get_file_list()
-        
-        hashed_local_list = [os.path.basename(self._get_renamed_filename(x)) for x in filename_list]
+        with timer.stage('list'):
+            sd_file_indexes = self.get_cached_file_indexes()
+
+        with timer.stage('hash'):
+            if self.content_namer:
+                self.content_namer.assign(filename_list)
+            assignment = self.assign_shards(filename_list)
 
         # If force upload, we are going to delete all the files in this directory
-        if force:
-            files_to_delete_list = sd_file_list
-        else:
-            # Delete any file not present in the filename_list
-            files_to_delete_list = [ fn for fn in sd_file_list if not fn in hashed_local_list]
-
-        #for fn in sd_file_list:
-            #if not fn in hashed_local_list:
-        for fn in files_to_delete_list:
-            print("Deleting file %s on FlashAir" % fn)
-            self.delete_file(fn)
-
-        # Now, for any file not already present in the SD card, upload it
-        i = 0
-        n = len(filename_list)
-        for fn, hash_fn in zip(filename_list, hashed_local_list):
-
-            i+=1
-            if force or not hash_fn in sd_file_list:
-                print("[%d/%d] Uploading file %s to %s on FlashAir" % (i,n,fn, hash_fn))
-                self.upload_file(fn)
+        plans = {}
+        with timer.stage('plan'):
+            for card_path in sorted(sd_file_indexes):
+                plans[card_path] = self.plan_sync(assignment.get(card_path, []), sd_file_indexes[card_path], force)
+                logging.debug("%s: %s", card_path, plans[card_path])
+        changed = [card_path for card_path in sorted(plans) if plans[card_path].has_changes]
+
+        executor = CardExecutor(self.workers)
+        upload_sessions = {}
+        for card_path in sorted(plans):
+            plan = plans[card_path]
+            upload_sessions[card_path] = self.upload_session(write_protect=False, card_path=card_path)
+            if self.shards > 1:
+                print("FlashAir directory %s: %d to delete, %d to upload, %d already present" % (
+                        card_path, len(plan.delete), len(plan.upload), len(plan.skip)))
+            for item in plan.skip:
+                print("[%d/%d] Uploading file %s to %s on FlashAir: SKIPPED(already present)" % (item.index, plan.total, item.path, item.name))
+
+        if changed:
+            for card_path in plans:
+                self.invalidate_manifest(card_path)
+            self.save_shard_dirs(self.load_shard_dirs() + self.shard_dirs)
+            # Put the card into write-protect mode before we change it
+            self._set_write_protect()
+
+            # Delete everything first to make room, then upload a directory at a time
+            with timer.stage('delete'):
+                self._delete_stale(executor, dict((card_path, plans[card_path].delete) for card_path in changed))
+
+            # Now, for any file not already present in the SD card, upload it
+            with timer.stage('upload'):
+                for card_path in changed:
+                    plan = plans[card_path]
+                    if batch_uploads:
+                        upload = upload_sessions[card_path].upload
+                    else:
+                        upload = lambda fn, card_name, card_path=card_path: self.upload_file(fn, card_name, card_path)
+                    upload_ops = []
+                    for item in plan.upload:
+                        message = "[%d/%d] Uploading file %s to %s on FlashAir" % (item.index, plan.total, item.path, item.name)
+                        upload_ops.append(CardOperation('upload', item.path, self._uploader(upload, item.path, item.name, message), item.size))
+                    executor.run(upload_ops)
+            executor.report()
+            self.progress.report()
+
+        if self.manifest_dir:
+            if changed:
+                # Clear the card's update status, so only changes made after this sync are reported
+                self.is_card_updated()
+            for card_path in sorted(plans):
+                if card_path not in self.shard_dirs:
+                    continue
+                plan = plans[card_path]
+                index = dict((fn, sd_file_indexes[card_path][fn]) for fn in plan.keep)
+                for item in plan.upload:
+                    index[item.name] = upload_sessions[card_path].card_entry(item.name, item.size)
+                self.save_manifest(index, card_path)
+            self._save_emptied_shard_dirs(sd_file_indexes)
+
+    def sync_stream(self, filename_list, ready_files, force=False):
+        """
+            Like :meth:`sync_files_on_card_to_list`, but each file is uploaded
+            as soon as it is ready, while later ones are still being prepared.
+
+            Stale files are deleted up front, which only needs the names the
+            files will have on the card, so this can't be used with content
+            based names.
+
+            :param filename_list: every local file that will be synced
+            :param ready_files: iterable of the files to upload as they become
+                                ready, with the same basenames as filename_list
+        """
+        if self.content_namer:
+            raise ValueError("Streaming syncs need card names that don't depend on the file contents")
+
+        timer = self.timer
+        self.fat32_time = None
+        with timer.stage('list'):
+            sd_file_indexes = self.get_cached_file_indexes()
+
+        with timer.stage('plan'):
+            shard_of = {}
+            for card_path, filenames in self.assign_shards(filename_list).items():
+                for fn in filenames:
+                    shard_of[self.card_name(fn)] = card_path
+            # Files that will be replaced are overwritten by their upload, everything else goes now
+            deletes = {}
+            for card_path in sorted(sd_file_indexes):
+                deletes[card_path] = [name for name in sorted(sd_file_indexes[card_path])
+                                      if force or shard_of.get(name) != card_path]
+
+        executor = CardExecutor(self.workers)
+        state = {'changed': False}
+        def changing():
+            if not state['changed']:
+                for card_path in sd_file_indexes:
+                    self.invalidate_manifest(card_path)
+                self.save_shard_dirs(self.load_shard_dirs() + self.shard_dirs)
+                self._set_write_protect()
+                state['changed'] = True
+
+        if any(deletes.values()):
+            changing()
+            with timer.stage('delete'):
+                self._delete_stale(executor, deletes)
+            for card_path, names in deletes.items():
+                for name in names:
+                    del sd_file_indexes[card_path][name]
+
+        upload_sessions = {}
+        state['session'] = None
+        def flush(card_path):
+            batch, pending[card_path] = pending[card_path], []
+            if not batch:
+                return
+            changing()
+            session = upload_sessions.setdefault(card_path, self.upload_session(write_protect=False, card_path=card_path))
+            if session is not state['session']:
+                # The upload directory is sticky on the card, so send it again after switching
+                session.started = False
+                state['session'] = session
+            with timer.stage('upload'):
+                executor.run([CardOperation('upload', path, self._uploader(session.upload, path, name, message), size)
+                              for path, name, size, message in batch])
+            for path, name, size, message in batch:
+                sd_file_indexes[card_path][name] = session.card_entry(name, size)
+
+        # Upload as soon as files are ready with one directory, but gather a few
+        # per directory when sharding, since each switch costs an UPDIR
+        batch_size = self.workers if self.shards == 1 else max(self.workers, STREAM_SHARD_BATCH)
+        pending = dict((card_path, []) for card_path in sd_file_indexes)
+        uploaded = set()
+        total = len(filename_list)
+        for i, path in enumerate(ready_files):
+            name = self.card_name(path)
+            card_path = shard_of.get(name)
+            if card_path is None:
+                logging.debug("Ignoring %s, which was not in the list of files to sync" % path)
+                continue
+            size = os.path.getsize(path)
+            message = "[%d/%d] Uploading file %s to %s on FlashAir" % (i+1, total, path, name)
+            entry = sd_file_indexes[card_path].get(name)
+            if name in uploaded or (not force and entry is not None and entry.size == size):
+                print(message + ": SKIPPED(already present)")
+                continue
+
+            pending[card_path].append((path, name, size, message))
+            uploaded.add(name)
+            if len(pending[card_path]) >= batch_size:
+                flush(card_path)
+        for card_path in sorted(pending):
+            flush(card_path)
+
+        if state['changed']:
+            executor.report()
+            self.progress.report()
+
+        if self.manifest_dir:
+            if state['changed']:
+                self.is_card_updated()
+            for card_path in self.shard_dirs:
+                self.save_manifest(sd_file_indexes[card_path], card_path)
+            self._save_emptied_shard_dirs(sd_file_indexes)
+
+    def _delete_stale(self, executor, deletes):
+        """
+            :param deletes: dict of card directory to the filenames to delete from it
+        """
+        delete_ops = []
+        for card_path in sorted(deletes):
+            to_delete = deletes[card_path]
+            if self.bulk_delete and len(to_delete) > 1:
+                to_delete = self._bulk_delete(card_path, to_delete)
+            for fn in to_delete:
+                delete_ops.append(CardOperation('delete', fn, self._deleter(fn, card_path), 0))
+        executor.run(delete_ops)
+
+    def plan_sync(self, filename_list, sd_file_index, force=False):
+        """
+            :returns: SyncPlan to make the card directory match the local files
+        """
+        return plan_sync(filename_list, sd_file_index, self.card_name, force)
+
+    def _deleter(self, filename, card_path=None):
+        def delete():
+            print("Deleting file %s on FlashAir" % filename)
+            self.delete_file(filename, card_path)
+        return delete
+
+    def _uploader(self, upload, filename, card_name, message):
+        def upload_one():
+            print(message)
+            upload(filename, card_name=card_name)
+        return upload_one
+
+class CardEntry(object):
+    """
+        One file or directory in a card listing
+    """
+    __slots__ = ('directory', 'name', 'size', 'attributes', 'timestamp')
+
+    ATTR_DIRECTORY = 0x10
+    ATTR_ARCHIVE = 0x20
+
+    def __init__(self, directory, name, size, attributes, timestamp):
+        """
+            :param timestamp: modification time, or None if the card didn't record one
+            :type timestamp: datetime.datetime
+        """
+        self.directory = directory
+        self.name = name
+        self.size = size
+        self.attributes = attributes
+        self.timestamp = timestamp
+
+    def __repr__(self):
+        return "CardEntry(%r, %r, %d, 0x%02X, %r)" % (self.directory, self.name, self.size, self.attributes, self.timestamp)
 
+    @property
+    def is_dir(self):
+        return bool(self.attributes & self.ATTR_DIRECTORY)
+
+    @classmethod
+    def decode_fat_datetime(cls, fat_date, fat_time):
+        """
+            :returns: datetime for the FAT date and time fields, or None if unset or invalid
+        """
+        try:
+            return datetime.datetime((fat_date >> 9) + 1980, (fat_date >> 5) & 0x0F, fat_date & 0x1F,
+                                     fat_time >> 11, (fat_time >> 5) & 0x3F, (fat_time & 0x1F) * 2)
+        except ValueError:
+            return None
+
+    @classmethod
+    def encode_fat_datetime(cls, timestamp):
+        """
+            :returns: (date, time) FAT fields for the datetime, or (0, 0) for None
+        """
+        if timestamp is None:
+            return (0, 0)
+        return (((timestamp.year-1980) << 9) | (timestamp.month << 5) | timestamp.day,
+                (timestamp.hour << 11) | (timestamp.minute << 5) | (timestamp.second >> 1))
+
+    def to_line(self):
+        """
+            :returns: the entry formatted as a WLANSD_FILELIST line
+        """
+        fat_date, fat_time = self.encode_fat_datetime(self.timestamp)
+        return "%s,%s,%d,%d,%d,%d" % (self.directory, self.name, self.size, self.attributes, fat_date, fat_time)
+
+    @classmethod
+    def from_line(cls, line):
+        """
+            :returns: CardEntry for a WLANSD_FILELIST line, or None if it isn't a valid entry
+        """
+        values = line.strip().split(',')
+        if len(values) < 6:
+            return None
+        # The directory itself could contain commas, so index from the end
+        try:
+            size, attributes, fat_date, fat_time = [int(x) for x in values[-4:]]
+        except ValueError:
+            return None
+        directory = ','.join(values[:-5])
+        return cls(directory, values[-5].strip(), size, attributes, cls.decode_fat_datetime(fat_date, fat_time))
+
+
+class UploadSession(object):
+    """
+        Card state for a run of uploads.  The write-protect mode, upload
+        directory and file timestamp are sticky on the card, so they are only
+        sent once per session (the timestamp is shared by every directory,
+        so it is only sent again if it changes).
+    """
+    def __init__(self, flashair, card_path, write_protect=True):
+        """
+            :param flashair: The card to upload to
+            :type flashair: FlashAir
+            :param card_path: Directory on the card to upload into
+            :param write_protect: Put the card into host write-protect mode first
+        """
+        self.flashair = flashair
+        self.card_path = card_path
+        self.write_protect = write_protect
+        self.fat32_time = None
+        self.started = False
+        # Uploads run on several threads, and only one of them should set up the card
+        self.lock = threading.RLock()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.started = False
+
+    def start(self, t=None):
+        """
+            :param t: Timestamp for the uploaded files, defaults to now
+            :type t: time.struct_time
+        """
+        with self.lock:
+            if self.started:
+                return
+            if self.write_protect:
+                self.flashair._set_write_protect()
+            self.flashair.set_upload_dir(self.card_path)
+            if t is None and self.flashair.fat32_time is not None:
+                # Another directory's session already stamped this sync
+                self.fat32_time = self.flashair.fat32_time
             else:
-                print("[%d/%d] Uploading file %s to %s on FlashAir: SKIPPED(already present)" % (i,n,fn, hash_fn))
+                self.set_timestamp(t or time.localtime())
+            self.started = True
+
+    def set_timestamp(self, t):
+        fat32_time = self.flashair._fat32_time(t)
+        with self.lock:
+            if fat32_time != self.flashair.fat32_time:
+                self.flashair.set_timestamp(t)
+            self.fat32_time = fat32_time
+
+    def card_entry(self, name, size):
+        """
+            :returns: CardEntry for a file uploaded in this session
+        """
+        timestamp = None
+        if self.fat32_time is not None:
+            timestamp = CardEntry.decode_fat_datetime(self.fat32_time >> 16, self.fat32_time & 0xFFFF)
+        return CardEntry(self.card_path, name, size, CardEntry.ATTR_ARCHIVE, timestamp)
+
+    def upload(self, filename, t=None, card_name=None):
+        """
+            :param filename: Local file to upload, renamed to its hashed 8.3 name on the card
+            :param t: Timestamp for this file, if different from the session's
+            :type t: time.struct_time
+            :param card_name: The name on the card, if already known
+        """
+        self.start(t)
+        if t is not None:
+            self.set_timestamp(t)
+
+        hash_filename = card_name or self.flashair.card_name(filename)
+
+        flashair = self.flashair
+        progress = flashair.progress.start_file(hash_filename, os.path.getsize(filename))
+        body = MultipartFileStream('file', hash_filename, filename, flashair.chunk_size,
+                                   flashair.rate_limiter, progress)
+        try:
+            flashair._post("upload.cgi", data=body, headers={'Content-Type': body.content_type})
+        finally:
+            body.close()
+        flashair.progress.finish_file(progress)
+
 
 def main():
     #logging.basicConfig(level=logging.DEBUG, format='%(message)s')
@@ -16,10 +16,38 @@
 import argparse
 import sys, os
 import logging
+import json
+import re
+import threading
+import time
+from collections import deque
+
+from concurrent.futures import ThreadPoolExecutor
 
 import yaml
 import flickrapi
-import urllib
+
+from download import Downloader
+from imaging import pick_size
+from pipeline import PhotoStream
+
+# The url_* extras for every size Flickr can return, smallest first.  Which
+# ones come back depends on the photo's size and the owner's settings.
+SIZE_LABELS = ['sq', 't', 's', 'q', 'm', 'n', 'z', 'c', 'l', 'h', 'k', 'o']
+# The original is only a candidate when it is a JPEG, since the frame shows nothing else
+SIZE_EXTRAS = ",".join("url_%s" % label for label in SIZE_LABELS) + ",original_format"
+
+# The authorized token is kept next to flickr_api.yaml, readable only by its owner
+TOKEN_FILE = "flickr_token.yaml"
+
+# Flickr error codes for a token that has been revoked or lacks permission
+TOKEN_ERRORS = ('98', '99')
+
+# The most photos Flickr returns in one page of a listing
+MAX_PER_PAGE = 500
+
+# Also needed to keep a photo index up to date between listings
+LISTING_EXTRAS = SIZE_EXTRAS + ",date_upload,last_update,tags"
 
 
 class Photo(object):
@@ -28,24 +56,235 @@ class Photo(object):
         attrs = { 'farm': 'farmid', 'server':'serverid','id':'photoid','secret':'secret'}
         for flickr_attr, py_attr in attrs.items():
             setattr(self, py_attr, photo_element.get(flickr_attr))
+        # Everything Flickr sent, so the photo can be saved in a PhotoIndex and rebuilt later
+        self.attrs = dict(photo_element.items())
+
+        # (width, height, label, url) of each size returned with the size extras
+        self.sizes = []
+        for label in SIZE_LABELS:
+            if label == 'o' and photo_element.get('originalformat', '').lower() not in ('jpg', 'jpeg'):
+                continue
+            url = photo_element.get('url_%s' % label)
+            width, height = photo_element.get('width_%s' % label), photo_element.get('height_%s' % label)
+            if url and width and height:
+                self.sizes.append((int(width), int(height), label, url))
         
     def _construct_flickr_url(self):
         url = "http://farm%s.staticflickr.com/%s/%s_%s_b.jpg" % (self.farmid,self.serverid, self.photoid, self.secret)
         return url
 
-    def download_photo(self, dirname, cache=False, tgt_filename=None):
-        if not os.path.exists(dirname):
-            os.makedirs(dirname)
-        tgt = os.path.join(dirname, "%s.jpg" % self.photoid)
-        if cache:
-            if os.path.isfile(tgt):
-                return tgt
-        urllib.urlretrieve(self._construct_flickr_url(), tgt)
-        return tgt
+    def variant(self, box=None):
+        """
+            :param box: (width, height) the photo will be resized to fit, or None
+            :returns: (size label, url) of the smallest size that fills the box,
+                      with a label of None for the default 1024px size
+        """
+        if not box or not self.sizes:
+            return (None, self._construct_flickr_url())
+        return pick_size(self.sizes, box)[2:]
+
+    def filename(self, dirname, box=None):
+        # Each size is cached separately, so changing the box never reuses a smaller download
+        label, url = self.variant(box)
+        if label:
+            return os.path.join(dirname, "%s_%s.jpg" % (self.photoid, label))
+        return os.path.join(dirname, "%s.jpg" % self.photoid)
+
+    def download_photo(self, dirname, cache=False, tgt_filename=None, downloader=None, box=None):
+        """
+            :type downloader: Downloader
+            :param box: (width, height) the photo will be resized to fit, to pick its size
+        """
+        downloader = downloader or Downloader(workers=1)
+        return downloader.download(self.variant(box)[1], self.filename(dirname, box), cache)
         
+class PhotoListing(object):
+    """
+        The first count photos of a Flickr listing, fetched a page at a time
+        with several pages in flight, and produced as they arrive so the
+        downloads can start on the first page while later ones are fetched.
+
+        Photos that move between pages while they are being fetched are
+        only produced once.  Iterating again reuses the photos already fetched.
+    """
+    def __init__(self, method, count, workers=4, per_page=MAX_PER_PAGE, on_complete=None, **kwargs):
+        """
+            :param method: flickrapi method to call for each page, e.g. photos_search
+            :param count: Max number of photos to list
+            :param workers: Max number of pages in flight
+            :param on_complete: Called with the list of photos once all of them have been fetched
+            :param kwargs: Arguments for every call to the method
+        """
+        self.method = method
+        self.count = count
+        self.workers = workers
+        self.per_page = max(1, min(count, per_page))
+        self.on_complete = on_complete
+        self.kwargs = kwargs
+        self.first = None
+        self.photos = None
+        self.complete = False
+        # Photos in the whole listing, as Flickr reported with the first page
+        self.total = None
+
+    def _page(self, page):
+        """
+            :returns: (list of Photo, number of pages, number of photos in the listing)
+        """
+        xml = self.method(page=page, per_page=self.per_page, **self.kwargs)
+        photos = Flickr._extract_photos_from_xml(xml)
+        info = xml.find('photos')
+        if info is None:
+            return (photos, 1, len(photos))
+        return (photos, int(info.get('pages', 1)), int(info.get('total', len(photos))))
+
+    def _first_page(self):
+        if self.first is None:
+            self.first = self._page(1)
+        return self.first
+
+    def __len__(self):
+        if self.photos is not None:
+            return len(self.photos)
+        if self.count <= 0:
+            return 0
+        return min(self.count, self._first_page()[2])
+
+    def __iter__(self):
+        if self.photos is not None:
+            return iter(self.photos)
+        return self._fetch()
+
+    def _fetch(self):
+        listed = []
+        if self.count <= 0:
+            photos, pages = [], 0
+        else:
+            photos, pages, self.total = self._first_page()
+        seen = set()
+        complete = True
+        pool = ThreadPoolExecutor(max_workers=self.workers)
+        pending = deque()
+        next_page = 2
+        try:
+            while True:
+                for photo in photos:
+                    if len(listed) == self.count:
+                        break
+                    if photo.photoid not in seen:
+                        seen.add(photo.photoid)
+                        listed.append(photo)
+                        yield photo
+                if len(listed) >= self.count:
+                    break
+                if not pending:
+                    # Ask for the pages that should hold the rest; more are
+                    # needed if photos moved between pages and were skipped
+                    wanted = (self.count - len(listed) + self.per_page - 1) // self.per_page
+                    last_page = min(pages, next_page + wanted - 1)
+                    pending.extend(pool.submit(self._page, page) for page in range(next_page, last_page + 1))
+                    next_page = last_page + 1
+                    if not pending:
+                        break
+                try:
+                    photos = pending.popleft().result()[0]
+                except Exception as e:
+                    print("Could not get the rest of the photos from flickr: %s" % e)
+                    complete = False
+                    break
+        finally:
+            for future in pending:
+                future.cancel()
+            pool.shutdown(wait=True)
+        self.photos = listed
+        self.complete = complete
+        if complete and self.on_complete:
+            self.on_complete(listed)
+
+
+class PhotoIndex(object):
+    """
+        The photos each listing returned last time, saved between runs so
+        later runs only need to ask Flickr which photos changed since then.
+
+        Flickr doesn't report deleted photos as changes, so a full listing is
+        still done once a day to catch them.
+    """
+    # Seconds between full listings
+    FULL_LISTING_INTERVAL = 24*60*60
+    # Overlap between updates, in case our clock is ahead of Flickr's
+    CLOCK_MARGIN = 10*60
+    # More changes than this, and a full listing is quicker
+    MAX_UPDATES = 2000
+
+    def __init__(self, filename=None):
+        """
+            :param filename: JSON file to load/save the index, or None to keep it in memory
+        """
+        self.filename = filename
+        self.listings = {}
+        if filename and os.path.isfile(filename):
+            try:
+                with open(filename) as f:
+                    self.listings = json.load(f)
+            except ValueError:
+                logging.debug("Ignoring unreadable photo index %s" % filename)
+
+    def get(self, key, count, now=None):
+        """
+            :returns: the saved listing, or None if a full listing is needed
+        """
+        listing = self.listings.get(key)
+        now = now or time.time()
+        if not listing or listing['count'] < count or now - listing['full_listed_at'] > self.FULL_LISTING_INTERVAL:
+            return None
+        # Photos that dropped out of the listing leave a gap only a full listing can fill
+        if listing.get('total') is None or len(listing['photos']) < min(count, listing['total']):
+            return None
+        return listing
+
+    def put(self, key, count, photos, listed_at, full_listed_at=None, total=None):
+        """
+            :param total: Photos in the whole listing on Flickr, which can be more than count
+        """
+        previous = self.listings.get(key, {})
+        self.listings[key] = {'count': count, 'listed_at': listed_at,
+                              'full_listed_at': full_listed_at or previous.get('full_listed_at', listed_at),
+                              'total': total if total is not None else previous.get('total'),
+                              'photos': [photo.attrs for photo in photos]}
+        self.save()
+
+    def save(self):
+        if not self.filename:
+            return
+        dirname = os.path.dirname(self.filename)
+        if dirname and not os.path.exists(dirname):
+            os.makedirs(dirname)
+        with open(self.filename + ".tmp", 'w') as f:
+            json.dump(self.listings, f)
+        os.rename(self.filename + ".tmp", self.filename)
+
+
+def normalize_tag(tag):
+    """ Flickr's form of a tag, as returned by the tags extra """
+    return re.sub(r'[\W_]', '', tag.lower(), flags=re.UNICODE)
+
+
 class Flickr(object):
 
-    def __init__(self):
+    def __init__(self, downloader=None, box=None, index=None):
+        """
+            :param downloader: Downloads the photos, defaults to 4 at a time
+            :type downloader: Downloader
+            :param box: (width, height) the photos will be resized to fit, so
+                        the smallest size that fills it can be downloaded
+            :param index: Photos found by earlier runs, to only ask Flickr for changes
+            :type index: PhotoIndex
+        """
+        self.downloader = downloader or Downloader()
+        self.box = box
+        self.index = index
+        self.auth_lock = threading.Lock()
         self.set_keys(*self.read_keys())
         self.get_auth2()
 
@@ -61,44 +300,162 @@ class Flickr(object):
         self.api_key = key
         self.api_secret = secret
 
+    def read_token(self):
+        """
+            :returns: the saved token, or None if there isn't one
+        """
+        if not os.path.isfile(TOKEN_FILE):
+            return None
+        with open(TOKEN_FILE) as f:
+            saved = yaml.safe_load(f) or {}
+        return saved.get("token")
+
+    def write_token(self, token):
+        tmp = TOKEN_FILE + ".tmp"
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+        with os.fdopen(fd, 'w') as f:
+            f.write(yaml.safe_dump({"token": token}, default_flow_style=False))
+        os.chmod(tmp, 0600)
+        os.rename(tmp, TOKEN_FILE)
+
+    def forget_token(self):
+        if os.path.isfile(TOKEN_FILE):
+            os.remove(TOKEN_FILE)
+
     def get_auth2(self):
+        """
+            Use the saved token without checking it with Flickr, which only
+            costs a round trip if it turns out to have been revoked (see
+            :meth:`_api`), and only do the full handshake if there is none.
+        """
+        token = self.read_token()
+        if token:
+            logging.debug("Using the saved Flickr token")
+            self.flickr = flickrapi.FlickrAPI(self.api_key, self.api_secret, token=token)
+            return
+        self.authenticate()
+
+    def authenticate(self):
         print("Authenticating to Flickr")
         self.flickr = flickrapi.FlickrAPI(self.api_key, self.api_secret)
         (token,frob) = self.flickr.get_token_part_one(perms='read')
         if not token: raw_input("Press ENTER after you authorized this program")
-        self.flickr.get_token_part_two((token,frob))
+        token = self.flickr.get_token_part_two((token,frob))
+        self.write_token(token)
         print("Authentication succeeded")
 
+    def _api(self, name):
+        """
+            :returns: function calling the flickrapi method, which authenticates
+                      again and retries if the saved token has been revoked
+        """
+        def call(**kwargs):
+            flickr = self.flickr
+            try:
+                return getattr(flickr, name)(**kwargs)
+            except flickrapi.FlickrError as e:
+                match = re.match(r'Error: (\d+):', str(e))
+                if not match or match.group(1) not in TOKEN_ERRORS:
+                    raise
+                with self.auth_lock:
+                    # Another page of the listing may have authenticated already
+                    if self.flickr is flickr:
+                        print("The saved Flickr token was rejected (%s)" % e)
+                        self.forget_token()
+                        self.authenticate()
+            return getattr(self.flickr, name)(**kwargs)
+        return call
 
-    def get_tagged(self, tags, count, download_dir="photos"):
+
+    def get_tagged(self, tags, count, download_dir="photos", stream=False):
         """ Get photos with the given list of tags
+
+            :param stream: Return a PhotoStream that downloads the photos as
+                           it is iterated over, instead of downloading them first
         """
         print ("connecting to flickr, and getting %d photos with tags %s" % (count, tags))
-        x = self.flickr.photos_search(api_key = self.api_key, user_id="me", tags=','.join(tags), per_page=count)
-        photos = self._extract_photos_from_xml(x)
-        photo_filenames = self._sync_photos(photos, download_dir)
+        wanted = set(normalize_tag(tag) for tag in tags)
+        matches = lambda photo: bool(wanted & set(photo.attrs.get('tags', '').split()))
+        photos = self._list_photos("tags:%s" % ",".join(sorted(wanted)), count, self._api('photos_search'), matches,
+                                   tags=','.join(tags))
+        photo_filenames = self._sync_photos(photos, download_dir, stream=stream)
         print("Found %d photos" % len(photos))
         return photo_filenames
 
 
-    def _sync_photos(self, photos, download_dir="photos", clean_up=False):
+    def _list_photos(self, key, count, method, matches, **kwargs):
+        """
+            List the photos, by applying the changes since the last run to the
+            photo index if possible, or with a full listing otherwise.
+
+            :param key: Name of the listing in the photo index
+            :param method: flickrapi method for a full listing
+            :param matches: function telling whether a changed photo belongs in the listing
+            :returns: iterable of Photo, newest first
+        """
+        listed_at = time.time()
+        saved = self.index.get(key, count, listed_at) if self.index else None
+        if saved:
+            updated = self._apply_updates(saved, matches, count)
+            if updated is not None:
+                photos, total = updated
+                self.index.put(key, count, photos, listed_at, total=total)
+                return photos
+
+        listing = PhotoListing(method, count, api_key=self.api_key, user_id="me", extras=LISTING_EXTRAS, **kwargs)
+        if self.index:
+            listing.on_complete = lambda photos: self.index.put(key, count, photos, listed_at, listed_at, listing.total)
+        return listing
+
+    def _apply_updates(self, saved, matches, count):
+        """
+            :param saved: the listing from the photo index
+            :returns: (the photos in the listing now, the new total), or None if
+                      the changes couldn't all be fetched or photos dropped out
+                      of the listing and older ones must be listed to replace them
+        """
+        min_date = int(saved['listed_at'] - PhotoIndex.CLOCK_MARGIN)
+        updates = PhotoListing(self._api('photos_recentlyUpdated'), PhotoIndex.MAX_UPDATES,
+                               api_key=self.api_key, min_date=min_date, extras=LISTING_EXTRAS)
+        changed = list(updates)
+        if not updates.complete or len(changed) >= PhotoIndex.MAX_UPDATES:
+            return None
+        logging.debug("%d photos changed on flickr since the last run" % len(changed))
+
+        photos = dict((attrs['id'], Photo(attrs)) for attrs in saved['photos'])
+        total = saved['total']
+        for photo in changed:
+            if matches(photo):
+                if photo.photoid not in photos:
+                    total += 1
+                photos[photo.photoid] = photo
+            elif photos.pop(photo.photoid, None) is not None:
+                total -= 1
+        if len(photos) < min(count, total):
+            logging.debug("Photos dropped out of the listing, listing it all again")
+            return None
+        # Listings are newest first
+        newest = sorted(photos.values(), key=lambda photo: int(photo.attrs.get('dateupload', 0)), reverse=True)
+        return (newest[:count], total)
+
+    def _sync_photos(self, photos, download_dir="photos", clean_up=False, stream=False):
         """
             Connect to flickr, and for each photo in the list, download.
             Then, if delete photos that are present locally that weren't present in the list of photos.
 
             :returns: List of filenames downloaded
         """
-        photo_filenames = []
-        photo_count = len(photos)
-        for i,photo in enumerate(photos):
-            print("[%d/%d] Downloading %s from flickr" % (i,photo_count,photo.photoid))
-            filename = photo.download_photo(download_dir, cache=True)
-            photo_filenames.append(filename)
+        if stream:
+            # The full list is needed up front to plan the sync
+            photos = list(photos)
+            return PhotoStream([x.filename(download_dir, self.box) for x in photos],
+                               self._download_photos(photos, download_dir))
+        photo_filenames = list(self._download_photos(photos, download_dir))
 
         # Now, go through and clean up directory if required
         
         if clean_up:
-            photo_file_list = ["%s.jpg" % (x.photoid) for x in photos]
+            photo_file_list = [os.path.basename(x.filename(download_dir, self.box)) for x in photos]
             for fn in os.listdir(download_dir):
                 full_fn = os.path.join(download_dir, fn)
                 if os.path.isfile(full_fn):
@@ -108,7 +465,23 @@ class Flickr(object):
 
         return photo_filenames
 
-    def _extract_photos_from_xml(self, xml):
+    def _download_photos(self, photos, download_dir):
+        """
+            Download the photos concurrently, skipping any that fail.
+
+            :returns: iterator of the downloaded filenames, in the same order as photos
+        """
+        photo_count = len(photos)
+        jobs = ((photo.variant(self.box)[1], photo.filename(download_dir, self.box)) for photo in photos)
+        for i, (url, filename, error) in enumerate(self.downloader.download_iter(jobs, cache=True)):
+            if error:
+                print("[%d/%d] Could not download %s from flickr, skipping it: %s" % (i+1, photo_count, url, error))
+                continue
+            print("[%d/%d] Downloaded %s from flickr" % (i+1, photo_count, os.path.basename(filename)))
+            yield filename
+
+    @staticmethod
+    def _extract_photos_from_xml(xml):
         photos = []
         for i in xml.iter():
             if i.tag == 'rsp':
@@ -122,15 +495,17 @@ class Flickr(object):
                 photos.append(Photo(i))
         return photos
 
-    def get_recent(self,count, download_dir="photos"):
+    def get_recent(self,count, download_dir="photos", stream=False):
         """ get the most recent photos
+
+            :param stream: Return a PhotoStream that downloads the photos as
+                           it is iterated over, instead of downloading them first
         """
         print ("connecting to flickr, and getting most recent %d photos" % count)
-        x = self.flickr.people_getphotos(api_key = self.api_key, user_id="me",per_page=count)
+        photos = self._list_photos("recent", count, self._api('people_getphotos'), lambda photo: True)
         #x = self.flickr.photos_search(api_key=self.api_key,"me")
 
-        photos = self._extract_photos_from_xml(x)
-        photo_filenames = self._sync_photos(photos, download_dir)
+        photo_filenames = self._sync_photos(photos, download_dir, stream=stream)
         return photo_filenames
 
 
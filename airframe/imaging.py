@@ -0,0 +1,400 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright 2013 Virantha Ekanayake All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import sys, os
+import logging
+import hashlib
+import io
+import json
+import multiprocessing
+import shutil
+import time
+from collections import deque
+
+from PIL import Image
+
+# Let the JPEG decoder scale down until the image is no smaller than this
+# multiple of the target size, so the final filter still has detail to work with
+DRAFT_MARGIN = 1.5
+
+# Lowest quality the byte budget search will go down to
+MIN_QUALITY = 30
+DEFAULT_QUALITY = 85
+
+ORIENTATION_TAG = 0x0112
+# How to undo each EXIF orientation, since the frame ignores the tag
+ORIENTATION_TRANSPOSE = {2: Image.FLIP_LEFT_RIGHT, 3: Image.ROTATE_180, 4: Image.FLIP_TOP_BOTTOM,
+                         5: Image.TRANSPOSE, 6: Image.ROTATE_270, 7: Image.TRANSVERSE, 8: Image.ROTATE_90}
+
+
+def parse_size(s):
+    """
+        :param s: box like 1024x768
+        :returns: (width, height)
+    """
+    return tuple(int(x) for x in s.split('x'))
+
+
+def parse_bytes(s):
+    """
+        :param s: size like 300000, 300k or 2m
+        :returns: number of bytes
+    """
+    s = s.strip().lower()
+    multiplier = {'k': 1024, 'm': 1024*1024}.get(s[-1:], 1)
+    if multiplier > 1:
+        s = s[:-1]
+    return int(float(s) * multiplier)
+
+
+def fit_size(size, box):
+    """
+        :returns: the largest size with the same aspect ratio as size that
+                  fits in box, or size itself if it already fits
+    """
+    width, height = size
+    if width > box[0]:
+        height = max(height * box[0] // width, 1)
+        width = box[0]
+    if height > box[1]:
+        width = max(width * box[1] // height, 1)
+        height = box[1]
+    return (width, height)
+
+
+def pick_size(sizes, box):
+    """
+        Pick the smallest of the sizes an image is available in that still
+        fills the box, so it isn't downloaded bigger than the frame can show,
+        or the biggest one if none of them do.
+
+        :param sizes: list of tuples starting with (width, height)
+        :param box: (width, height) the image will be resized to fit
+        :returns: the chosen tuple
+    """
+    # A size fills the box if it reaches the box's width or height once scaled to fit
+    covering = [size for size in sizes if size[0] >= box[0] or size[1] >= box[1]]
+    area = lambda size: size[0] * size[1]
+    if covering:
+        return min(covering, key=area)
+    return max(sizes, key=area)
+
+
+def shrink(im, box):
+    """
+        Shrink a freshly opened image to fit in the box.  JPEGs are decoded
+        straight to 1/2, 1/4 or 1/8 scale where that still leaves enough
+        pixels, which saves most of the decoding time and memory for big
+        originals, and the rest of the way is done with a high quality filter.
+
+        :returns: the shrunk image, or im itself if it already fits
+    """
+    target = fit_size(im.size, box)
+    if target == im.size:
+        return im
+    im.draft(im.mode, (int(target[0] * DRAFT_MARGIN), int(target[1] * DRAFT_MARGIN)))
+    return im.resize(target, Image.ANTIALIAS)
+
+
+def get_orientation(im):
+    """
+        :returns: the EXIF orientation of a freshly opened image, 1 if it has none
+    """
+    try:
+        exif = im._getexif() if hasattr(im, '_getexif') else None
+    except Exception:
+        logging.debug("Ignoring unreadable EXIF data in %s" % getattr(im, 'filename', im))
+        exif = None
+    return (exif or {}).get(ORIENTATION_TAG, 1)
+
+
+def encode_jpeg(im, quality=DEFAULT_QUALITY, max_bytes=None, optimize=False):
+    """
+        Encode the image as a JPEG without any metadata.  With a byte budget,
+        the highest quality (up to the given one) that fits in it is found by
+        a binary search, going no lower than MIN_QUALITY.
+
+        :returns: the JPEG data
+    """
+    if im.mode not in ('RGB', 'L'):
+        im = im.convert('RGB')
+
+    def encode(q):
+        out = io.BytesIO()
+        im.save(out, format='JPEG', quality=q, optimize=optimize)
+        return out.getvalue()
+
+    data = encode(quality)
+    if not max_bytes or len(data) <= max_bytes:
+        return data
+    low, high = MIN_QUALITY, quality - 1
+    best = None
+    while low <= high:
+        q = (low + high) // 2
+        candidate = encode(q)
+        if len(candidate) <= max_bytes:
+            best, low = candidate, q + 1
+        else:
+            high = q - 1
+    if best is None:
+        logging.debug("Could not fit %s in %d bytes, using quality %d" % (getattr(im, 'filename', 'image'), max_bytes, MIN_QUALITY))
+        best = encode(MIN_QUALITY)
+    return best
+
+
+def resize_image(job):
+    """
+        Shrink one image to fit in the box, if it doesn't already, and
+        re-encode it if it needs rotating or is over the byte budget.
+        Runs in a worker process, so errors are returned rather than raised.
+
+        :param job: (filename, target filename, (width, height) or None, encoding),
+                    where the target may be the same file to resize it in place, and
+                    encoding is a dict of encode_jpeg arguments, or None for the defaults
+        :returns: (filename, error message or None)
+    """
+    filename, target, size, encoding = job
+    encoding = encoding or {}
+    try:
+        # Opening only reads the header, so pictures that are fine as they are never decoded
+        im = Image.open(filename)
+        orientation = get_orientation(im)
+        if size and orientation in (5, 6, 7, 8):
+            # The box applies to the picture the way up it will be shown
+            size = (size[1], size[0])
+        needs_shrink = size and fit_size(im.size, size) != im.size
+        max_bytes = encoding.get('max_bytes')
+        if needs_shrink or orientation in ORIENTATION_TRANSPOSE or (max_bytes and os.path.getsize(filename) > max_bytes):
+            if needs_shrink:
+                im = shrink(im, size)
+            if orientation in ORIENTATION_TRANSPOSE:
+                im = im.transpose(ORIENTATION_TRANSPOSE[orientation])
+            _write(encode_jpeg(im, **encoding), target)
+        elif target != filename:
+            shutil.copyfile(filename, target + ".tmp")
+            os.rename(target + ".tmp", target)
+        im.close()
+    except Exception as e:
+        return (filename, "%s: %s" % (e.__class__.__name__, e))
+    return (filename, None)
+
+
+def _write(data, target):
+    # Write to a temporary file first so an interrupted run never leaves a partial image
+    tmp = target + ".tmp"
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.rename(tmp, target)
+
+
+def resize_images(filenames, size, jobs=None, targets=None, encoding=None):
+    """
+        Resize the images in a pool of worker processes.  Each worker only
+        holds the image it's working on, so memory use depends on the number
+        of workers rather than the number of images.
+
+        :param filenames: images to resize
+        :param size: (width, height) box to fit the images in, or None to keep their size
+        :param jobs: number of worker processes, defaults to the number of cores
+        :param targets: where to write each resized image, defaults to resizing in place
+        :param encoding: dict of encode_jpeg arguments (quality, max_bytes, optimize)
+        :returns: list of (filename, error message or None), in the same order as filenames
+    """
+    jobs = jobs or multiprocessing.cpu_count()
+    work = [(fn, target, size, encoding) for fn, target in zip(filenames, targets or filenames)]
+    if jobs <= 1 or len(work) <= 1:
+        return [resize_image(job) for job in work]
+
+    pool = multiprocessing.Pool(min(jobs, len(work)), maxtasksperchild=100)
+    try:
+        # imap hands out one image at a time, and returns results in order
+        results = list(pool.imap(resize_image, work, chunksize=1))
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    return results
+
+
+class DerivativeCache(object):
+    """
+        Resized copies of the pictures, keyed by the source picture's content,
+        the box it was resized to and the encoding settings.
+
+        The originals are never modified, so changing the box always starts
+        from the full quality picture, and going back to a box that was used
+        before is just an index lookup.  The least recently used copies are
+        evicted once the cache grows past max_bytes.
+    """
+    def __init__(self, cache_dir, hasher, max_bytes=500*1024*1024, settings=None):
+        """
+            :param cache_dir: Directory for the resized pictures and the index
+            :param hasher: Used to key the cache by picture content
+            :type hasher: ContentHasher
+            :param max_bytes: Size to evict the cache down to
+            :param settings: dict of encode_jpeg arguments, which also key the cache
+        """
+        self.cache_dir = cache_dir
+        self.hasher = hasher
+        self.max_bytes = max_bytes
+        self.settings = settings or {}
+        self.index_filename = os.path.join(cache_dir, "index.json")
+        self.index = {}
+        if os.path.isfile(self.index_filename):
+            try:
+                with open(self.index_filename) as f:
+                    self.index = json.load(f)
+            except ValueError:
+                logging.debug("Ignoring unreadable derivative index %s" % self.index_filename)
+
+    def key(self, filename, size):
+        settings = json.dumps(self.settings, sort_keys=True)
+        box = "%dx%d" % size if size else "-"
+        return hashlib.sha1("%s:%s:%s" % (self.hasher.digest(filename), box, settings)).hexdigest()
+
+    def path(self, key, filename):
+        # Keep the source's name, since the name on the card can depend on it
+        return os.path.join(self.cache_dir, key[:16], os.path.basename(filename))
+
+    def lookup(self, key):
+        """
+            :returns: the cached file for the key, or None on a miss
+        """
+        entry = self.index.get(key)
+        if entry is None:
+            return None
+        path = os.path.join(self.cache_dir, entry['file'])
+        if not os.path.isfile(path) or os.path.getsize(path) != entry['size']:
+            del self.index[key]
+            return None
+        entry['used'] = time.time()
+        return path
+
+    def add(self, key, path):
+        self.index[key] = {'file': os.path.relpath(path, self.cache_dir), 'size': os.path.getsize(path),
+                           'used': time.time()}
+
+    def resize(self, filenames, size, jobs=None):
+        """
+            Get a resized copy of every picture, only resizing the ones that
+            aren't already in the cache.
+
+            :returns: list of (resized filename, error message or None), in the same order as filenames
+        """
+        keys = [self.key(fn, size) for fn in filenames]
+        results = [None] * len(filenames)
+        misses = []
+        for i, (fn, key) in enumerate(zip(filenames, keys)):
+            path = self.lookup(key)
+            if path:
+                results[i] = (path, None)
+            else:
+                misses.append(i)
+        logging.debug("Derivative cache: %d hits, %d misses" % (len(filenames) - len(misses), len(misses)))
+
+        targets = [self.path(keys[i], filenames[i]) for i in misses]
+        for target in targets:
+            if not os.path.exists(os.path.dirname(target)):
+                os.makedirs(os.path.dirname(target))
+        resized = resize_images([filenames[i] for i in misses], size, jobs, targets, self.settings)
+        for i, target, (fn, error) in zip(misses, targets, resized):
+            if error:
+                results[i] = (fn, error)
+            else:
+                self.add(keys[i], target)
+                results[i] = (target, None)
+
+        self.evict(set(keys))
+        self.save()
+        return results
+
+    def resize_iter(self, filenames, size, jobs=None):
+        """
+            Like :meth:`resize`, but takes and produces one picture at a time,
+            so pictures can be resized while later ones are still being
+            fetched and earlier ones uploaded.  At most twice jobs pictures
+            are waiting to be resized at once.
+
+            :param filenames: iterable of pictures
+            :returns: iterator of (resized filename, error message or None), in the same order as filenames
+        """
+        jobs = jobs or multiprocessing.cpu_count()
+        pool = multiprocessing.Pool(jobs, maxtasksperchild=100)
+        pending = deque()
+        keys = set()
+        try:
+            for fn in filenames:
+                key = self.key(fn, size)
+                keys.add(key)
+                path = self.lookup(key)
+                if path:
+                    pending.append((fn, key, path, None))
+                else:
+                    target = self.path(key, fn)
+                    if not os.path.exists(os.path.dirname(target)):
+                        os.makedirs(os.path.dirname(target))
+                    job = (fn, target, size, self.settings)
+                    pending.append((fn, key, target, pool.apply_async(resize_image, [job])))
+                while pending and (pending[0][3] is None or pending[0][3].ready() or len(pending) > 2*jobs):
+                    yield self._finish(*pending.popleft())
+            while pending:
+                yield self._finish(*pending.popleft())
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+            self.evict(keys)
+            self.save()
+
+    def _finish(self, filename, key, path, result):
+        if result is not None:
+            error = result.get()[1]
+            if error:
+                return (filename, error)
+            self.add(key, path)
+        return (path, None)
+
+    def evict(self, keep=()):
+        """
+            Remove the least recently used pictures until the cache fits in max_bytes
+
+            :param keep: keys that must not be evicted
+        """
+        total = sum(entry['size'] for entry in self.index.values())
+        for key in sorted(self.index, key=lambda k: self.index[k]['used']):
+            if total <= self.max_bytes:
+                break
+            if key in keep:
+                continue
+            entry = self.index.pop(key)
+            path = os.path.join(self.cache_dir, entry['file'])
+            if os.path.exists(path):
+                os.remove(path)
+                try:
+                    os.rmdir(os.path.dirname(path))
+                except OSError:
+                    pass
+            total -= entry['size']
+
+    def save(self):
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        with open(self.index_filename + ".tmp", 'w') as f:
+            json.dump(self.index, f)
+        os.rename(self.index_filename + ".tmp", self.index_filename)
@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright 2013 Virantha Ekanayake All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import os
+import logging
+import threading
+import time
+import uuid
+
+
+class RateLimiter(object):
+    """
+        Caps the combined rate of all the uploads sharing this limiter, so the
+        frame's Wi-Fi link isn't saturated.
+    """
+    def __init__(self, max_kbps):
+        """
+            :param max_kbps: Maximum transfer rate in kilobits per second
+        """
+        self.bytes_per_sec = max_kbps * 1000.0 / 8
+        self.lock = threading.Lock()
+        self.next_time = time.time()
+
+    def consume(self, nbytes):
+        """ Block until nbytes may be sent """
+        with self.lock:
+            now = time.time()
+            start = max(now, self.next_time)
+            self.next_time = start + nbytes / self.bytes_per_sec
+        if start > now:
+            time.sleep(start - now)
+
+
+class TransferProgress(object):
+    """
+        Byte-level progress for each file and for the whole sync.
+    """
+    def __init__(self, interval=1.0):
+        """
+            :param interval: Minimum seconds between progress lines for a file
+        """
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.start_time = None
+        self.total_bytes = 0
+        self.files = 0
+
+    def _rate(self, nbytes, seconds):
+        return nbytes / 1024.0 / max(seconds, 1e-6)
+
+    def start_file(self, name, size):
+        with self.lock:
+            if self.start_time is None:
+                self.start_time = time.time()
+        return FileProgress(self, name, size)
+
+    def finish_file(self, progress):
+        with self.lock:
+            self.total_bytes += progress.sent
+            self.files += 1
+        elapsed = time.time() - progress.start_time
+        print("  %s: %d KB in %.1fs (%.1f KB/s)" % (progress.name, progress.sent/1024, elapsed,
+                                                     self._rate(progress.sent, elapsed)))
+
+    def report(self):
+        if not self.files:
+            return
+        elapsed = time.time() - self.start_time
+        print("Uploaded %d files, %d KB in %.1fs (%.1f KB/s)" % (self.files, self.total_bytes/1024, elapsed,
+                                                                  self._rate(self.total_bytes, elapsed)))
+
+
+class FileProgress(object):
+    def __init__(self, transfer, name, size):
+        self.transfer = transfer
+        self.name = name
+        self.size = size
+        self.sent = 0
+        self.start_time = time.time()
+        self.last_report = self.start_time
+
+    def update(self, nbytes):
+        self.sent += nbytes
+        now = time.time()
+        if now - self.last_report >= self.transfer.interval and self.sent < self.size:
+            self.last_report = now
+            print("  %s: %d/%d KB (%.1f KB/s)" % (self.name, self.sent/1024, self.size/1024,
+                                                 self.transfer._rate(self.sent, now - self.start_time)))
+
+
+class MultipartFileStream(object):
+    """
+        File-like multipart/form-data body for a single file upload.
+
+        The body is produced on demand as the HTTP library reads it, with the
+        file read in fixed size chunks, so memory use stays flat regardless of
+        the size of the image.  The length is known up front so the request
+        is still sent with a Content-Length header.
+    """
+    def __init__(self, field, filename, path, chunk_size=64*1024, rate_limiter=None, progress=None):
+        """
+            :param field: Form field name
+            :param filename: File name sent in the form
+            :param path: Local file to send
+            :param chunk_size: Bytes read from the file at a time
+            :param rate_limiter: Optional RateLimiter to throttle the upload
+            :type rate_limiter: RateLimiter
+            :param progress: Optional FileProgress to report the bytes sent to
+            :type progress: FileProgress
+        """
+        self.boundary = uuid.uuid4().hex
+        self.path = path
+        self.chunk_size = chunk_size
+        self.rate_limiter = rate_limiter
+        self.progress = progress
+        self.header = ('--%s\r\n'
+                       'Content-Disposition: form-data; name="%s"; filename="%s"\r\n'
+                       'Content-Type: application/octet-stream\r\n\r\n') % (self.boundary, field, filename)
+        self.trailer = '\r\n--%s--\r\n' % self.boundary
+        self.file_size = os.path.getsize(path)
+        self.len = len(self.header) + self.file_size + len(self.trailer)
+        self.file = None
+        self.buffer = self.header
+        self.done = False
+
+    @property
+    def content_type(self):
+        return 'multipart/form-data; boundary=%s' % self.boundary
+
+    def __len__(self):
+        return self.len
+
+    def _fill(self):
+        if self.file is None:
+            self.file = open(self.path, 'rb')
+        chunk = self.file.read(self.chunk_size)
+        if chunk:
+            if self.rate_limiter:
+                self.rate_limiter.consume(len(chunk))
+            if self.progress:
+                self.progress.update(len(chunk))
+            self.buffer += chunk
+        else:
+            self.buffer += self.trailer
+            self.close()
+            self.done = True
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.len
+        while len(self.buffer) < size and not self.done:
+            self._fill()
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            logging.debug("Closed upload file %s" % self.path)
+        self.file = None
@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright 2013 Virantha Ekanayake All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import os
+import logging
+import hashlib
+import json
+import threading
+
+
+class ContentHasher(object):
+    """
+        SHA-1 digests of file contents, cached by (path, size, mtime) so
+        unchanged files are never read twice.  The cache is optionally kept
+        in a JSON file between runs.
+    """
+    def __init__(self, cache_filename=None):
+        """
+            :param cache_filename: JSON file to load/save the cache, or None to keep it in memory
+        """
+        self.cache_filename = cache_filename
+        self.lock = threading.Lock()
+        self.cache = {}
+        self.dirty = False
+        if cache_filename and os.path.isfile(cache_filename):
+            try:
+                with open(cache_filename) as f:
+                    self.cache = json.load(f)
+            except ValueError:
+                logging.debug("Ignoring unreadable hash cache %s" % cache_filename)
+
+    def digest(self, filename):
+        """
+            :returns: hex SHA-1 digest of the file's contents
+        """
+        path = os.path.abspath(filename)
+        st = os.stat(path)
+        with self.lock:
+            cached = self.cache.get(path)
+        if cached and cached[0] == st.st_size and cached[1] == st.st_mtime:
+            return cached[2]
+
+        h = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024*1024), b''):
+                h.update(chunk)
+        digest = h.hexdigest()
+        with self.lock:
+            self.cache[path] = [st.st_size, st.st_mtime, digest]
+            self.dirty = True
+        return digest
+
+    def save(self):
+        """ Write the cache back, dropping entries for files that no longer exist """
+        if not self.cache_filename or not self.dirty:
+            return
+        with self.lock:
+            cache = dict((path, v) for path, v in self.cache.items() if os.path.exists(path))
+            dirname = os.path.dirname(self.cache_filename)
+            if dirname and not os.path.exists(dirname):
+                os.makedirs(dirname)
+            with open(self.cache_filename + ".tmp", 'w') as f:
+                json.dump(cache, f)
+            os.rename(self.cache_filename + ".tmp", self.cache_filename)
+            self.dirty = False
+
+
+class ContentNamer(object):
+    """
+        Names files on the card after a hash of their contents, so the same
+        picture from different sources (or under a different filename) is
+        only stored once.
+
+        Names are 8 hex digits from the SHA-1 digest.  If two different
+        pictures would get the same name, the one with the larger digest
+        moves to the next 8-digit window of its digest, so the resolution
+        only depends on the set of pictures being synced.
+    """
+    def __init__(self, hasher):
+        """
+            :type hasher: ContentHasher
+        """
+        self.hasher = hasher
+        self.names = {}
+        self.collisions = 0
+
+    def assign(self, filename_list):
+        """
+            Work out the card name for every file in the list.
+
+            :returns: dict of local filename to card filename
+        """
+        digests = dict((fn, self.hasher.digest(fn)) for fn in filename_list)
+        self.hasher.save()
+
+        by_digest = {}
+        used = set()
+        for digest in sorted(set(digests.values())):
+            for start in xrange(0, len(digest) - 7):
+                name = "%s.JPG" % digest[start:start+8].upper()
+                if name not in used:
+                    break
+                self.collisions += 1
+                logging.warning("Card name collision on %s, trying the next window of %s" % (name, digest))
+            else:
+                raise ValueError("Could not find a unique card name for digest %s" % digest)
+            used.add(name)
+            by_digest[digest] = name
+
+        self.names = dict((fn, by_digest[digest]) for fn, digest in digests.items())
+        return self.names
+
+    def __call__(self, filename):
+        """
+            :returns: the card name assigned to the file, or its default name
+                      if it wasn't part of the last assign()
+        """
+        name = self.names.get(filename)
+        if name is None:
+            name = "%s.JPG" % self.hasher.digest(filename)[:8].upper()
+        return name
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright 2013 Virantha Ekanayake All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import sys
+import logging
+import threading
+import Queue
+
+# How far each stage can get ahead of the next one
+QUEUE_SIZE = 8
+
+_DONE = object()
+
+
+class PhotoStream(object):
+    """
+        The pictures a source is going to produce, known before any of them
+        are fetched, and an iterator that produces them as they arrive.
+    """
+    def __init__(self, filenames, ready):
+        """
+            :param filenames: every local file the source will produce
+            :param ready: iterable of the local files, each one as soon as it has been fetched
+        """
+        self.filenames = filenames
+        self.ready = ready
+
+    def __iter__(self):
+        return iter(self.ready)
+
+    def __len__(self):
+        return len(self.filenames)
+
+
+def background(iterable, maxsize=QUEUE_SIZE):
+    """
+        Run an iterator in a thread of its own, so it keeps producing items
+        while the consumer is busy with earlier ones.  It is never more than
+        maxsize items ahead of the consumer, and any exception it raises is
+        raised in the consumer.
+
+        :returns: iterator over the items, in order
+    """
+    queue = Queue.Queue(maxsize)
+    stop = threading.Event()
+
+    def put(item):
+        # Give up if the consumer has gone away, rather than blocking forever
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+            put((_DONE, None))
+        except Exception:
+            logging.debug("Pipeline stage failed", exc_info=True)
+            put((_DONE, sys.exc_info()))
+
+    # Start right away, rather than when the consumer first asks for an item
+    thread = threading.Thread(target=produce)
+    thread.daemon = True
+    thread.start()
+    return _consume(queue, stop)
+
+
+def _consume(queue, stop):
+    try:
+        while True:
+            try:
+                # With a timeout, so Ctrl-C still works while waiting
+                item, error = queue.get(timeout=1)
+            except Queue.Empty:
+                continue
+            if item is _DONE:
+                if error:
+                    raise error[0], error[1], error[2]
+                return
+            yield item
+    finally:
+        stop.set()
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright 2013 Virantha Ekanayake All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import os
+import time
+from collections import namedtuple
+
+PlanItem = namedtuple('PlanItem', ['index', 'path', 'name', 'size'])
+
+class SyncPlan(object):
+    """
+        What a sync needs to do to make a card directory match the local files.
+
+        :ivar delete: card filenames to delete, sorted
+        :ivar upload: PlanItem for every local file to upload
+        :ivar skip: PlanItem for every local file already on the card (or a
+                    duplicate of another local file going to the same card name)
+        :ivar keep: card filenames that stay on the card untouched
+    """
+    def __init__(self):
+        self.delete = []
+        self.upload = []
+        self.skip = []
+        self.keep = []
+        self.delete_bytes = 0
+        self.upload_bytes = 0
+        self.skip_bytes = 0
+        self.total = 0
+
+    @property
+    def has_changes(self):
+        return bool(self.delete or self.upload)
+
+    def __repr__(self):
+        return "SyncPlan(delete=%d files/%d bytes, upload=%d files/%d bytes, skip=%d files/%d bytes)" % (
+                len(self.delete), self.delete_bytes, len(self.upload), self.upload_bytes,
+                len(self.skip), self.skip_bytes)
+
+
+def plan_sync(filename_list, card_index, namer, force=False, getsize=os.path.getsize):
+    """
+        Work out which files to delete from and upload to a card directory.
+
+        Each local file is named and sized exactly once, and all lookups are
+        against dicts/sets, so planning is linear in the number of files.
+
+        :param filename_list: local files that should end up on the card
+        :param card_index: dict of card filename to CardEntry (anything with a size)
+        :param namer: function returning the card filename for a local file
+        :param force: delete and re-upload everything
+        :param getsize: function returning the size of a local file
+        :returns: SyncPlan
+    """
+    plan = SyncPlan()
+    plan.total = len(filename_list)
+
+    local = {}
+    items = []
+    for i, path in enumerate(filename_list):
+        name = namer(path)
+        item = PlanItem(i+1, path, name, getsize(path))
+        items.append(item)
+        local.setdefault(name, item)
+
+    # A file is only on the card if it has the same size as the local copy
+    present = set()
+    if not force:
+        for name, entry in card_index.iteritems():
+            item = local.get(name)
+            if item is not None and item.size == entry.size:
+                present.add(name)
+
+    for name in sorted(card_index):
+        if name in present:
+            plan.keep.append(name)
+        else:
+            plan.delete.append(name)
+            plan.delete_bytes += card_index[name].size
+
+    queued = set()
+    for item in items:
+        if item.name in present or item.name in queued:
+            plan.skip.append(item)
+            plan.skip_bytes += item.size
+        else:
+            queued.add(item.name)
+            plan.upload.append(item)
+            plan.upload_bytes += item.size
+
+    return plan
+
+
+class _Entry(object):
+    __slots__ = ('size',)
+    def __init__(self, size):
+        self.size = size
+
+def main():
+    """
+        Benchmark planning a sync of a 50k photo library against a 50k entry
+        card, half of which overlap.
+    """
+    n = 50000
+    filename_list = ["photos/%08d.jpg" % i for i in xrange(n)]
+    namer = lambda path: os.path.basename(path)[:8].upper() + ".JPG"
+    card_index = dict(("%08d.JPG" % i, _Entry(1000)) for i in xrange(n/2, n + n/2))
+
+    start = time.time()
+    plan = plan_sync(filename_list, card_index, namer, getsize=lambda path: 1000)
+    elapsed = time.time() - start
+    print(plan)
+    print("Planned %d local files against %d card files in %.1f ms" % (n, len(card_index), elapsed*1000))
+
+
+if __name__ == '__main__':
+    main()
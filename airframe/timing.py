@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright 2013 Virantha Ekanayake All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+
+class StageTimer(object):
+    """
+        Wall time spent in each stage of a run (fetch, resize, plan, ...).
+        Time in a stage that is entered several times, or from several
+        threads, is added up.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.times = {}
+
+    def add(self, name, seconds):
+        with self.lock:
+            self.times[name] = self.times.get(name, 0.0) + seconds
+
+    @contextmanager
+    def stage(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start
+            self.add(name, elapsed)
+            logging.debug("Stage %s took %.3fs", name, elapsed)
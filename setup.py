@@ -56,4 +56,5 @@ setup(
         'Programming Language :: Python :: 2.7',
     ],
     test_suite='tests',
+    tests_require=['mock'],
 )
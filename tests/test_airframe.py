@@ -8,21 +8,48 @@ test_airframe
 Tests for `airframe` module.
 """
 
+import os
+import shutil
+import tempfile
 import unittest
 
+from mock import patch, MagicMock
+
 from airframe import airframe
 
 
 class TestAirframe(unittest.TestCase):
 
     def setUp(self):
-        pass
+        self.script = airframe.AirFrame()
+        self.tmpdir = tempfile.mkdtemp()
 
     def test_something(self):
         pass
 
+    def test_multiple_hosts(self):
+        hosts_file = os.path.join(self.tmpdir, "frames.txt")
+        with open(hosts_file, 'w') as f:
+            f.write("# living room\nframe1\n\nframe2  # kitchen\n")
+        self.script.get_options(["--hosts-file", hosts_file, "10.0.0.5"])
+        self.assertEqual(self.script.flashair_hosts, ["10.0.0.5", "frame1", "frame2"])
+        self.assertEqual(self.script.flashair_ip, "10.0.0.5")
+
+    def test_host_required(self):
+        self.assertRaises(SystemExit, self.script.get_options, [])
+
+    def test_fleet_failure_raises(self):
+        self.script.get_options(["frame1", "frame2"])
+        def sync_card(hostname, photo_filenames):
+            if hostname == "frame2":
+                raise IOError("card not found")
+            return MagicMock()
+        with patch.object(self.script, 'sync_card', side_effect=sync_card):
+            self.assertRaises(IOError, self.script.sync_fleet, [])
+        self.assertEqual([error is None for hostname, seconds, nbytes, error in self.script.fleet_results], [True, False])
+
     def tearDown(self):
-        pass
+        shutil.rmtree(self.tmpdir)
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_benchmark
+----------------------------------
+
+Tests for `benchmark` module.
+"""
+
+import argparse
+import unittest
+
+from airframe.benchmark import compare, parse_args, parse_corpus
+
+
+class TestBenchmark(unittest.TestCase):
+
+    def setUp(self):
+        self.baseline = {'100 initial': {'wall': 10.0, 'requests': 300, 'bytes_sent': 10**7,
+                                         'peak_rss_kb': 50000, 'stages': {'upload': 8.0, 'plan': 0.01}}}
+
+    def test_parse_corpus(self):
+        self.assertEqual(parse_corpus("100x1024x768"), (100, (1024, 768)))
+        self.assertRaises(argparse.ArgumentTypeError, parse_corpus, "100")
+
+    def test_compare_flags_regressions(self):
+        results = {'100 initial': {'wall': 13.0, 'requests': 301, 'bytes_sent': 10**7,
+                                   'peak_rss_kb': 50000, 'stages': {'upload': 11.0, 'plan': 0.05}}}
+        regressions = compare(results, self.baseline, 0.2)
+        self.assertEqual(len(regressions), 2)
+        self.assertTrue(regressions[0].startswith("100 initial: wall") or regressions[1].startswith("100 initial: wall"))
+        self.assertEqual(compare(results, self.baseline, 0.5), [])
+
+    def test_airframe_args(self):
+        self.assertEqual(parse_args(['--', '--pipeline', '--card-workers', '2']).argv, ['--pipeline', '--card-workers', '2'])
+        self.assertEqual(parse_args(['--airframe-args=--pipeline']).airframe_args, '--pipeline')
+
+if __name__ == '__main__':
+    unittest.main()
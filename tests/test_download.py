@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_download
+----------------------------------
+
+Tests for `download` module.
+"""
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import BaseHTTPServer
+import SocketServer
+
+from airframe.download import Downloader, is_complete_jpeg
+
+
+class PhotoHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        data = self.server.photos.get(self.path)
+        if data is None:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.server.ranges_requested.append(self.headers.get('Range'))
+        if self.server.fail_next:
+            self.server.fail_next -= 1
+            self.send_response(503)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if self.server.ranges:
+            etag = '"%08x"' % (hash(data) & 0xffffffff)
+            start = int(self.headers.get('Range', 'bytes=0-')[len('bytes='):].split('-')[0])
+            if self.headers.get('If-Range') != etag:
+                # The photo changed, so send all of it
+                start = 0
+            self.send_response(206 if start else 200)
+            self.send_header('Accept-Ranges', 'bytes')
+            self.send_header('ETag', etag)
+            if start:
+                self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, len(data) - 1, len(data)))
+            data = data[start:]
+        else:
+            self.send_response(200)
+        if self.path in self.server.no_length:
+            # Without a length, the end of the photo is when the connection closes
+            self.send_header('Connection', 'close')
+            self.close_connection = 1
+        else:
+            self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        if self.path in self.server.truncate:
+            self.wfile.write(data[:len(data)/2])
+            self.close_connection = 1
+        else:
+            self.wfile.write(data)
+
+
+class PhotoServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class TestDownloader(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.server = PhotoServer(('127.0.0.1', 0), PhotoHandler)
+        self.server.photos = dict(("/%d.jpg" % i, os.urandom(10000 + i)) for i in range(10))
+        self.server.truncate = set()
+        self.server.ranges = False
+        self.server.fail_next = 0
+        self.server.no_length = set()
+        self.server.requests = []
+        self.server.ranges_requested = []
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.index_filename = os.path.join(self.tmpdir, "downloads.json")
+
+    def _url(self, path):
+        return "http://127.0.0.1:%d%s" % (self.server.server_address[1], path)
+
+    def _jobs(self, paths):
+        return [(self._url(path), os.path.join(self.tmpdir, "photos", path[1:])) for path in paths]
+
+    def test_concurrent_downloads_in_order(self):
+        paths = sorted(self.server.photos) + ["/missing.jpg"]
+        downloader = Downloader(workers=4, index_filename=self.index_filename)
+        results = list(downloader.download_iter(self._jobs(paths)))
+        self.assertEqual([os.path.basename(fn) for url, fn, error in results], [path[1:] for path in paths])
+        self.assertEqual([error is None for url, fn, error in results], [True] * 10 + [False])
+        for url, fn, error in results[:-1]:
+            with open(fn, 'rb') as f:
+                self.assertEqual(f.read(), self.server.photos["/" + os.path.basename(fn)])
+
+        # Complete downloads are cached, even by a new downloader
+        self.server.requests = []
+        results = list(Downloader(workers=4, index_filename=self.index_filename).download_iter(self._jobs(paths[:-1])))
+        self.assertEqual([error for url, fn, error in results], [None] * 10)
+        self.assertEqual(self.server.requests, [])
+
+    def test_truncated_download_is_not_cached(self):
+        self.server.truncate.add("/0.jpg")
+        downloader = Downloader(workers=1, index_filename=self.index_filename)
+        [(url, filename, error)] = list(downloader.download_iter(self._jobs(["/0.jpg"])))
+        self.assertIsNotNone(error)
+        self.assertFalse(os.path.exists(filename))
+        self.assertFalse(os.path.exists(filename + ".part"))
+
+        # A partial file left by an older version is downloaded again
+        with open(filename, 'wb') as f:
+            f.write("partial")
+        self.server.truncate.clear()
+        self.assertFalse(downloader.is_cached(filename))
+        downloader.download(url, filename)
+        self.assertEqual(os.path.getsize(filename), 10000)
+        self.assertTrue(downloader.is_cached(filename))
+
+    def test_truncated_download_is_resumed(self):
+        self.server.ranges = True
+        self.server.truncate.add("/1.jpg")
+        downloader = Downloader(workers=1, index_filename=self.index_filename)
+        [(url, filename, error)] = list(downloader.download_iter(self._jobs(["/1.jpg"])))
+        self.assertIsNotNone(error)
+        self.assertFalse(os.path.exists(filename))
+        self.assertEqual(os.path.getsize(filename + ".part"), 5000)
+
+        # A passing server error doesn't lose the partial file
+        self.server.truncate.clear()
+        self.server.fail_next = 1
+        self.assertRaises(IOError, downloader.download, url, filename)
+        self.assertEqual(os.path.getsize(filename + ".part"), 5000)
+
+        # Only the rest of the photo is asked for
+        del self.server.ranges_requested[:]
+        downloader.download(url, filename)
+        self.assertEqual(self.server.ranges_requested, ["bytes=5000-"])
+        self.assertFalse(os.path.exists(filename + ".part"))
+        self.assertFalse(os.path.exists(filename + ".part.validator"))
+        with open(filename, 'rb') as f:
+            self.assertEqual(f.read(), self.server.photos["/1.jpg"])
+        self.assertTrue(downloader.is_cached(filename))
+
+    def test_changed_photo_is_not_resumed(self):
+        self.server.ranges = True
+        self.server.truncate.add("/1.jpg")
+        downloader = Downloader(workers=1)
+        [(url, filename, error)] = list(downloader.download_iter(self._jobs(["/1.jpg"])))
+        self.assertTrue(os.path.exists(filename + ".part"))
+
+        # The server sends the whole new photo instead of the rest of the old one
+        self.server.truncate.clear()
+        self.server.photos["/1.jpg"] = os.urandom(12000)
+        downloader.download(url, filename)
+        with open(filename, 'rb') as f:
+            self.assertEqual(f.read(), self.server.photos["/1.jpg"])
+
+    def test_download_without_length_must_be_jpeg(self):
+        self.server.no_length.update(["/0.jpg", "/1.jpg"])
+        self.server.photos["/1.jpg"] = "\xff\xd8" + "x" * 100 + "\xff\xd9"
+        downloader = Downloader(workers=1)
+        results = list(downloader.download_iter(self._jobs(["/0.jpg", "/1.jpg"])))
+        self.assertEqual([error is None for url, fn, error in results], [False, True])
+
+    def test_unrecorded_jpeg_is_checked(self):
+        downloader = Downloader(workers=1, index_filename=self.index_filename)
+        filename = os.path.join(self.tmpdir, "old.jpg")
+        with open(filename, 'wb') as f:
+            f.write("\xff\xd8" + "x" * 100)
+        self.assertFalse(is_complete_jpeg(filename))
+        self.assertFalse(downloader.is_cached(filename))
+
+        with open(filename, 'ab') as f:
+            f.write("\xff\xd9\x00\x00")
+        self.assertTrue(is_complete_jpeg(filename))
+        self.assertTrue(downloader.is_cached(filename))
+
+        # Once recorded, its size is what counts
+        with open(filename, 'ab') as f:
+            f.write("more")
+        self.assertFalse(downloader.is_cached(filename))
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmpdir)
+
+if __name__ == '__main__':
+    unittest.main()
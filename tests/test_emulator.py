@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_emulator
+----------------------------------
+
+End-to-end tests of `flashair` against the FlashAir `emulator`.
+"""
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from airframe.emulator import FlashAirEmulator
+from airframe.flashair import FlashAir
+
+
+class TestFlashAirEmulator(unittest.TestCase):
+
+    def setUp(self):
+        self.emulator = FlashAirEmulator(seed=1).start()
+        self.tmpdir = tempfile.mkdtemp()
+        self.manifest_dir = os.path.join(self.tmpdir, "cache")
+
+    def _make_files(self, n, prefix="photo"):
+        filenames = []
+        for i in range(n):
+            filename = os.path.join(self.tmpdir, "%s%d.jpg" % (prefix, i))
+            with open(filename, 'wb') as f:
+                f.write(os.urandom(1000 + i))
+            filenames.append(filename)
+        return filenames
+
+    def _card(self, **kwargs):
+        return FlashAir(self.emulator.hostname, manifest_dir=self.manifest_dir, **kwargs)
+
+    def _card_contents(self, card, filenames):
+        expected = {}
+        for fn in filenames:
+            with open(fn, 'rb') as f:
+                expected[card.card_name(fn)] = f.read()
+        return expected
+
+    def test_sync_then_noop_sync(self):
+        filenames = self._make_files(5)
+        card = self._card()
+        card.sync_files_on_card_to_list(filenames)
+        self.assertEqual(self.emulator.files(), self._card_contents(card, filenames))
+        self.assertEqual(self.emulator.stats['connections'], 1)
+
+        self.emulator.reset_stats()
+        self._card().sync_files_on_card_to_list(filenames)
+        self.assertEqual(self.emulator.stats['requests'], 1)
+
+    def test_sync_replaces_changed_set(self):
+        old = self._make_files(4, "old")
+        new = self._make_files(3, "new")
+        card = self._card()
+        card.sync_files_on_card_to_list(old)
+        # The frame wrote something too, so the card must be listed again
+        self.emulator.add_file("/DCIM/100__TSB/FRAME.JPG", "x")
+        card.sync_files_on_card_to_list(old[:1] + new)
+        self.assertEqual(self.emulator.files(), self._card_contents(card, old[:1] + new))
+
+    def test_truncated_upload_is_replaced(self):
+        filenames = self._make_files(2)
+        card = self._card()
+        self.emulator.add_file("/DCIM/100__TSB/%s" % card.card_name(filenames[0]), "trunc")
+        card.sync_files_on_card_to_list(filenames)
+        self.assertEqual(self.emulator.files(), self._card_contents(card, filenames))
+
+    def test_bulk_delete(self):
+        for i in range(20):
+            self.emulator.add_file("/DCIM/100__TSB/OLD%05d.JPG" % i, "old")
+        filenames = self._make_files(2)
+        card = self._card(bulk_delete=True)
+        card.sync_files_on_card_to_list(filenames)
+        self.assertEqual(self.emulator.files(), self._card_contents(card, filenames))
+        self.assertEqual(self.emulator.stats['GET /AIRFRAME.LUA'], 1)
+        self.assertTrue(card.bulk_delete)
+        self.assertEqual(sorted(self.emulator.files('/')), ['AIRFRAME.LUA'])
+
+    def test_concurrent_sync_survives_failures(self):
+        self.emulator.max_connections = 2
+        filenames = self._make_files(12)
+        card = self._card(workers=4)
+        # The first uploads fail; the executor should drop to serial and retry
+        self.emulator.fail_next(2, 'POST /upload.cgi')
+        card.sync_files_on_card_to_list(filenames)
+        self.assertEqual(self.emulator.files(), self._card_contents(card, filenames))
+
+    def test_concurrent_sync_sets_up_card_once(self):
+        filenames = self._make_files(12)
+        card = self._card(workers=4)
+        card.sync_files_on_card_to_list(filenames)
+        self.assertEqual(self.emulator.files(), self._card_contents(card, filenames))
+        # One UPDIR and one FTIME, not one per upload thread
+        self.assertEqual(self.emulator.stats['GET /upload.cgi'], 3)
+
+    def test_sharded_sync(self):
+        filenames = self._make_files(9)
+        card = self._card(shards=3, shard_cap=4)
+        card.sync_files_on_card_to_list(filenames)
+        synced = {}
+        for i in range(3):
+            files = self.emulator.files("/DCIM/1%02d__TSB" % i)
+            self.assertTrue(len(files) <= 4)
+            synced.update(files)
+        self.assertEqual(synced, self._card_contents(card, filenames))
+
+    def test_fewer_shards_empties_old_directories(self):
+        filenames = self._make_files(9)
+        self._card(shards=3, shard_cap=4).sync_files_on_card_to_list(filenames)
+        self.assertTrue(self.emulator.files("/DCIM/101__TSB"))
+        # A directory airframe never used is left alone
+        self.emulator.add_file("/DCIM/103__TSB/IMG_0001.JPG", "camera")
+
+        card = self._card()
+        card.sync_files_on_card_to_list(filenames)
+        self.assertEqual(self.emulator.files(), self._card_contents(card, filenames))
+        self.assertEqual(self.emulator.files("/DCIM/101__TSB"), {})
+        self.assertEqual(self.emulator.files("/DCIM/102__TSB"), {})
+        self.assertEqual(self.emulator.files("/DCIM/103__TSB"), {"IMG_0001.JPG": "camera"})
+
+    def test_unsharded_sync_leaves_other_directories(self):
+        self.emulator.add_file("/DCIM/101__TSB/IMG_0001.JPG", "camera")
+        filenames = self._make_files(3)
+        card = self._card()
+        card.sync_files_on_card_to_list(filenames)
+        self.assertEqual(self.emulator.files(), self._card_contents(card, filenames))
+        self.assertEqual(self.emulator.files("/DCIM/101__TSB"), {"IMG_0001.JPG": "camera"})
+        self.assertEqual(self.emulator.stats['GET /command.cgi'], 2)
+
+    def test_stream_sync(self):
+        old = self._make_files(4, "old")
+        new = self._make_files(3, "new")
+        card = self._card()
+        card.sync_files_on_card_to_list(old)
+        self.emulator.add_file("/DCIM/100__TSB/%s" % card.card_name(new[0]), "trunc")
+
+        self.emulator.reset_stats()
+        filenames = old[:2] + new
+        card = self._card()
+        card.sync_stream(filenames, iter(filenames))
+        self.assertEqual(self.emulator.files(), self._card_contents(card, filenames))
+        self.assertEqual(self.emulator.stats['POST /upload.cgi'], 3)
+
+        # The manifest reflects the streamed uploads, so nothing is listed or sent again
+        self.emulator.reset_stats()
+        self._card().sync_stream(filenames, iter(filenames))
+        self.assertEqual(self.emulator.stats['requests'], 1)
+
+    def test_sharded_stream_sync(self):
+        filenames = self._make_files(16)
+        card = self._card(shards=2)
+        card.sync_stream(filenames, iter(filenames))
+        synced = {}
+        for i in range(2):
+            synced.update(self.emulator.files("/DCIM/1%02d__TSB" % i))
+        self.assertEqual(synced, self._card_contents(card, filenames))
+        # Write protect and one FTIME, then an UPDIR per batch of files for a directory
+        self.assertTrue(self.emulator.stats['GET /upload.cgi'] <= 2 + 16 / 4 + 2)
+
+    def test_throttle_shares_throughput(self):
+        self.emulator.throughput = 10000
+        durations = []
+        def transfer():
+            start = time.time()
+            self.emulator._throttle(1000)
+            durations.append(time.time() - start)
+        threads = [threading.Thread(target=transfer) for _ in range(3)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        # Each transfer waits for its own 0.1s slot, one after the other
+        for duration, slot_end in zip(sorted(durations), [0.1, 0.2, 0.3]):
+            self.assertAlmostEqual(duration, slot_end, delta=0.05)
+
+    def tearDown(self):
+        self.emulator.stop()
+        shutil.rmtree(self.tmpdir)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_executor
+----------------------------------
+
+Tests for `executor` module.
+"""
+
+import threading
+import unittest
+
+from airframe.executor import CardExecutor, CardOperation
+
+
+class TestCardExecutor(unittest.TestCase):
+
+    def setUp(self):
+        self.done = []
+        self.lock = threading.Lock()
+
+    def _op(self, name, fail_once=False):
+        state = {'failed': False}
+        def func():
+            if fail_once and not state['failed']:
+                state['failed'] = True
+                raise IOError("card busy")
+            with self.lock:
+                self.done.append(name)
+        return CardOperation('upload', name, func, 10)
+
+    def test_runs_all_operations(self):
+        executor = CardExecutor(workers=3)
+        executor.run([self._op(str(i)) for i in range(10)])
+        self.assertEqual(sorted(self.done), sorted(str(i) for i in range(10)))
+        self.assertEqual(executor.workers, 3)
+
+    def test_error_drops_to_serial_and_retries(self):
+        executor = CardExecutor(workers=3)
+        executor.run([self._op("a"), self._op("b", fail_once=True), self._op("c")])
+        self.assertEqual(sorted(self.done), ["a", "b", "c"])
+        self.assertEqual(executor.workers, 1)
+        self.assertEqual(len([t for t in executor.timings if not t.ok]), 1)
+
+    def test_serial_errors_propagate(self):
+        executor = CardExecutor(workers=1)
+        self.assertRaises(IOError, executor.run, [self._op("a", fail_once=True)])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_facebookphotos
+----------------------------------
+
+Tests for `facebookphotos` module.
+"""
+
+import json
+import unittest
+import urlparse
+
+import facebook
+
+from mock import patch, MagicMock
+
+from airframe import facebookphotos
+
+
+def _image(width, height):
+    return {'width': width, 'height': height, 'source': "http://img/%dx%d" % (width, height)}
+
+
+class FakeSession(object):
+    """Answers Graph batch requests from a list of photo ids"""
+    def __init__(self, ids, hidden=()):
+        """
+            :param hidden: ids left out of their page, like photos filtered for privacy
+        """
+        self.ids = ids
+        self.hidden = set(hidden)
+        self.batches = []
+
+    def post(self, url, data, timeout):
+        batch = json.loads(data['batch'])
+        self.batches.append(batch)
+        results = []
+        for request in batch:
+            query = urlparse.parse_qs(urlparse.urlparse(request['relative_url']).query)
+            offset, limit = int(query['offset'][0]), int(query['limit'][0])
+            page = {'data': [{'id': i, 'images': [_image(2048, 1536), _image(960, 720)]}
+                             for i in self.ids[offset:offset+limit] if i not in self.hidden]}
+            if offset + limit < len(self.ids):
+                page['paging'] = {'next': "https://graph.facebook.com/next"}
+            results.append({'code': 200, 'body': json.dumps(page)})
+        response = MagicMock()
+        response.json.return_value = results
+        return response
+
+
+class TestFacebookPhotos(unittest.TestCase):
+
+    def _facebook(self, ids, box=None, hidden=()):
+        with patch.object(facebookphotos.FacebookPhotos, 'read_keys', return_value=("id", "secret", "client", "token")), \
+             patch.object(facebookphotos.FacebookPhotos, 'refresh_token'):
+            fb = facebookphotos.FacebookPhotos(box, MagicMock())
+        fb.graph.session = FakeSession(ids, hidden)
+        return fb
+
+    def test_list_batches_pages(self):
+        fb = self._facebook([str(i) for i in range(250)])
+        photos = list(fb.list_photos(1000))
+        self.assertEqual([p.photoid for p in photos], [str(i) for i in range(250)])
+        # One request for the first ten pages, stopping at the last one
+        self.assertEqual(len(fb.graph.session.batches), 1)
+
+    def test_list_continues_past_short_page(self):
+        ids = [str(i) for i in range(2500)]
+        fb = self._facebook(ids, hidden=ids[100:190])
+        photos = list(fb.list_photos(2000))
+        self.assertEqual(len(photos), 2000)
+        self.assertEqual(photos[100].photoid, "190")
+        self.assertEqual(len(fb.graph.session.batches), 3)
+
+    def test_list_stops_at_count(self):
+        fb = self._facebook([str(i) for i in range(250)])
+        self.assertEqual(len(list(fb.list_photos(120))), 120)
+        self.assertEqual(len(fb.graph.session.batches[0]), 2)
+
+    def test_list_skips_duplicates(self):
+        fb = self._facebook(["1", "2", "2", "3"])
+        self.assertEqual([p.photoid for p in fb.list_photos(10)], ["1", "2", "3"])
+
+    def test_image_covers_box(self):
+        fb = self._facebook(["1"], box=(800, 600))
+        photo = list(fb.list_photos(1))[0]
+        self.assertEqual(photo.source, "http://img/960x720")
+        self.assertEqual(photo.filename("photos"), "photos/1_960.jpg")
+
+        fb = self._facebook(["1"])
+        photo = list(fb.list_photos(1))[0]
+        self.assertEqual(photo.source, "http://img/2048x1536")
+        self.assertEqual(photo.filename("photos"), "photos/1.jpg")
+
+    def test_download_skips_failures(self):
+        fb = self._facebook(["1", "2", "3"], box=(800, 600))
+        jobs = []
+        def download_iter(photo_jobs, cache):
+            jobs.extend(photo_jobs)
+            return [(url, fn, IOError("cut short") if i == 1 else None) for i, (url, fn) in enumerate(jobs)]
+        fb.downloader.download_iter.side_effect = download_iter
+        self.assertEqual(fb.get_recent(3, "photos"), ["photos/1_960.jpg", "photos/3_960.jpg"])
+        self.assertEqual(jobs[0], ("http://img/960x720", "photos/1_960.jpg"))
+
+    def test_stream(self):
+        fb = self._facebook(["1", "2"])
+        fb.downloader.download_iter.side_effect = lambda jobs, cache: [(url, fn, None) for url, fn in jobs]
+        stream = fb.get_recent(2, "photos", stream=True)
+        self.assertEqual(stream.filenames, ["photos/1.jpg", "photos/2.jpg"])
+        self.assertFalse(fb.downloader.download_iter.called)
+        self.assertEqual(list(stream), ["photos/1.jpg", "photos/2.jpg"])
+
+    def test_batch_error(self):
+        fb = self._facebook([])
+        response = MagicMock()
+        response.json.return_value = [{'code': 400, 'body': json.dumps({'error': {'message': "Invalid token"}})}]
+        fb.graph.session = MagicMock()
+        fb.graph.session.post.return_value = response
+        self.assertRaises(facebook.GraphAPIError, fb.graph.batch, ["me/photos"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_flashair
+----------------------------------
+
+Tests for `flashair` module.
+"""
+
+import datetime
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from airframe.flashair import FlashAir, CardEntry
+
+
+class TestFlashAir(unittest.TestCase):
+
+    def setUp(self):
+        self.session = mock.MagicMock()
+        self.session.get.return_value.text = "WLANSD_FILELIST\n/DCIM/100__TSB,FA000001.JPG,128751,33,16602,18432\n"
+        self.session.get.return_value.content = "SUCCESS"
+        self.card = FlashAir("card", session=self.session, connect_timeout=1, read_timeout=2)
+        self.tmpdir = tempfile.mkdtemp()
+
+    def _make_files(self, n):
+        filenames = []
+        for i in range(n):
+            filename = os.path.join(self.tmpdir, "%d.jpg" % i)
+            with open(filename, 'wb') as f:
+                f.write("x" * (i+1))
+            filenames.append(filename)
+        return filenames
+
+    def test_requests_use_injected_session(self):
+        self.assertEqual(self.card.get_file_list(), ["FA000001.JPG"])
+        self.card.delete_file("FA000001.JPG")
+        self.assertEqual(self.session.get.call_count, 2)
+        for call in self.session.get.call_args_list:
+            self.assertEqual(call[1]['timeout'], (1, 2))
+
+    def test_sync_sets_up_card_once(self):
+        self.card.sync_files_on_card_to_list(self._make_files(3))
+        params = [call[1]['params'] for call in self.session.get.call_args_list]
+        self.assertEqual(sum(1 for p in params if 'UPDIR' in p), 1)
+        self.assertEqual(sum(1 for p in params if 'FTIME' in p), 1)
+        self.assertEqual(sum(1 for p in params if 'WRITEPROTECT' in p), 1)
+        self.assertEqual(self.session.post.call_count, 3)
+
+    def test_card_entry_decoding(self):
+        entry = CardEntry.from_line("/DCIM/100__TSB,FLASH6.JPG,387163,32,17295,31508\r")
+        self.assertEqual((entry.directory, entry.name, entry.size), ("/DCIM/100__TSB", "FLASH6.JPG", 387163))
+        self.assertEqual(entry.timestamp, datetime.datetime(2013, 12, 15, 15, 24, 40))
+        self.assertFalse(entry.is_dir)
+        self.assertEqual(CardEntry.from_line("/DCIM/100__TSB,FLASH3.JPG,370952,32,0,0").timestamp, None)
+        self.assertTrue(CardEntry.from_line("/DCIM,100__TSB,0,16,17295,31508").is_dir)
+        self.assertEqual(CardEntry.from_line(""), None)
+
+    def test_sync_replaces_truncated_files(self):
+        filenames = self._make_files(2)
+        names = [os.path.basename(self.card._get_renamed_filename(x)) for x in filenames]
+        # The first file is complete on the card, the second is truncated
+        self.session.get.return_value.text = "WLANSD_FILELIST\n/DCIM/100__TSB,%s,1,32,0,0\n/DCIM/100__TSB,%s,1,32,0,0\n" % tuple(names)
+        self.card.sync_files_on_card_to_list(filenames)
+        deleted = [call[1]['params']['DEL'] for call in self.session.get.call_args_list if 'DEL' in call[1]['params']]
+        self.assertEqual(deleted, ["/DCIM/100__TSB/%s" % names[1]])
+        self.assertEqual(self.session.post.call_count, 1)
+
+    def test_unchanged_card_uses_manifest(self):
+        listing = self.session.get.return_value
+        status = mock.MagicMock(text="0")
+        self.session.get.side_effect = lambda url, params, timeout: status if params.get('op') == 102 else listing
+        card = FlashAir("card", session=self.session, manifest_dir=self.tmpdir)
+        filenames = self._make_files(2)
+        card.sync_files_on_card_to_list(filenames)
+        self.assertEqual(sorted(card.load_manifest()),
+                         sorted(os.path.basename(card._get_renamed_filename(x)) for x in filenames))
+
+        self.session.reset_mock()
+        card.sync_files_on_card_to_list(filenames)
+        self.assertEqual([call[1]['params'] for call in self.session.get.call_args_list], [{'op': 102}])
+        self.assertEqual(self.session.post.call_count, 0)
+
+    def test_assign_shards(self):
+        card = FlashAir("card", session=self.session, shards=3, shard_cap=4)
+        filenames = ["%d.jpg" % i for i in range(12)]
+        assignment = card.assign_shards(filenames)
+        self.assertEqual(sorted(assignment), ["/DCIM/100__TSB", "/DCIM/101__TSB", "/DCIM/102__TSB"])
+        self.assertEqual([len(x) for x in assignment.values()], [4, 4, 4])
+        self.assertEqual(sorted(sum(assignment.values(), [])), sorted(filenames))
+        self.assertEqual(card.assign_shards(list(reversed(filenames)))["/DCIM/101__TSB"],
+                         list(reversed(assignment["/DCIM/101__TSB"])))
+        self.assertRaises(ValueError, card.assign_shards, filenames + ["extra.jpg"])
+
+    def test_sync_to_shards(self):
+        self.session.get.return_value.text = "WLANSD_FILELIST\n"
+        card = FlashAir("card", session=self.session, shards=2, shard_cap=10)
+        filenames = self._make_files(6)
+        card.sync_files_on_card_to_list(filenames)
+        params = [call[1]['params'] for call in self.session.get.call_args_list]
+        listed = sorted(p['DIR'] for p in params if p.get('op') == 100)
+        # No earlier sharded sync is recorded, so /DCIM isn't listed for leftovers
+        self.assertEqual(listed, ["/DCIM/100__TSB", "/DCIM/101__TSB"])
+        self.assertEqual(sorted(p['UPDIR'] for p in params if 'UPDIR' in p), ["/DCIM/100__TSB", "/DCIM/101__TSB"])
+        self.assertEqual(self.session.post.call_count, 6)
+
+    def test_bulk_delete_falls_back_to_single_deletes(self):
+        self.session.get.return_value.text = ("WLANSD_FILELIST\n/DCIM/100__TSB,OLD1.JPG,1,32,0,0\n"
+                                              "/DCIM/100__TSB,OLD2.JPG,1,32,0,0\n")
+        card = FlashAir("card", session=self.session, bulk_delete=True)
+        card.sync_files_on_card_to_list([])
+        deleted = [call[1]['params']['DEL'] for call in self.session.get.call_args_list if 'DEL' in call[1].get('params', {})]
+        self.assertEqual(deleted, ["/DCIM/100__TSB/OLD1.JPG", "/DCIM/100__TSB/OLD2.JPG"])
+        self.assertFalse(card.bulk_delete)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+if __name__ == '__main__':
+    unittest.main()
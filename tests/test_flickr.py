@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_flickr
+----------------------------------
+
+Tests for `flickr` module.
+"""
+
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+import xml.etree.ElementTree as ET
+
+import flickrapi
+
+from mock import patch, MagicMock
+
+from airframe import flickr
+
+
+class TestFlickr(unittest.TestCase):
+
+    def setUp(self):
+        self.downloader = MagicMock()
+        with patch.object(flickr.Flickr, 'read_keys', return_value=("key", "secret")), \
+             patch.object(flickr.Flickr, 'get_auth2'):
+            self.flickr = flickr.Flickr(self.downloader)
+
+    def _photos(self, n):
+        xml = ET.fromstring('<rsp stat="ok"><photos>%s</photos></rsp>' % "".join(
+                '<photo id="%d" farm="1" server="2" secret="s%d"/>' % (i, i) for i in range(n)))
+        return self.flickr._extract_photos_from_xml(xml)
+
+    def test_download_skips_failures(self):
+        photos = self._photos(3)
+        jobs = []
+        def download_iter(photo_jobs, cache):
+            jobs.extend(photo_jobs)
+            return [(url, fn, IOError("cut short") if i == 1 else None) for i, (url, fn) in enumerate(jobs)]
+        self.downloader.download_iter.side_effect = download_iter
+        self.assertEqual(self.flickr._sync_photos(photos, "photos"), ["photos/0.jpg", "photos/2.jpg"])
+        self.assertEqual(jobs[0], ("http://farm1.staticflickr.com/2/0_s0_b.jpg", "photos/0.jpg"))
+
+    def test_stream(self):
+        photos = self._photos(2)
+        self.downloader.download_iter.side_effect = lambda jobs, cache: [(url, fn, None) for url, fn in jobs]
+        stream = self.flickr._sync_photos(photos, "photos", stream=True)
+        self.assertEqual(stream.filenames, ["photos/0.jpg", "photos/1.jpg"])
+        self.assertFalse(self.downloader.download_iter.called)
+        self.assertEqual(list(stream), ["photos/0.jpg", "photos/1.jpg"])
+
+    def test_variant_covers_box(self):
+        xml = ET.fromstring('<photo id="7" farm="1" server="2" secret="s" '
+                            'url_m="http://m" width_m="500" height_m="375" '
+                            'url_z="http://z" width_z="640" height_z="480" '
+                            'url_l="http://l" width_l="1024" height_l="768" '
+                            'url_h="http://h" width_h="1600" height_h="1200"/>')
+        photo = flickr.Photo(xml)
+        self.assertEqual(photo.variant((640, 640)), ('z', 'http://z'))
+        self.assertEqual(photo.variant((800, 600)), ('l', 'http://l'))
+        self.assertEqual(photo.variant((4000, 3000)), ('h', 'http://h'))
+        self.assertEqual(photo.filename("photos", (800, 600)), "photos/7_l.jpg")
+        # Without a box, or without the size extras, get the default size
+        self.assertEqual(photo.variant(), (None, "http://farm1.staticflickr.com/2/7_s_b.jpg"))
+        self.assertEqual(photo.filename("photos"), "photos/7.jpg")
+
+    def test_original_only_if_jpeg(self):
+        sizes = ('url_h="http://h" width_h="1600" height_h="1200" '
+                 'url_o="http://o" width_o="4000" height_o="3000" originalformat="%s"')
+        photo = flickr.Photo(ET.fromstring('<photo id="7" %s/>' % (sizes % "png")))
+        self.assertEqual(photo.variant((4000, 3000)), ('h', 'http://h'))
+        photo = flickr.Photo(ET.fromstring('<photo id="7" %s/>' % (sizes % "jpg")))
+        self.assertEqual(photo.variant((4000, 3000)), ('o', 'http://o'))
+
+    def test_listing_pages_concurrently(self):
+        calls = []
+        def search(page, per_page, **kwargs):
+            calls.append((page, per_page, kwargs))
+            # Photo 4 moved from page 1 to page 2 while paging
+            ids = {1: range(0, 5), 2: range(4, 9), 3: range(10, 15), 4: range(15, 20)}[page]
+            return ET.fromstring('<rsp stat="ok"><photos page="%d" pages="4" total="20">%s</photos></rsp>' % (
+                    page, "".join('<photo id="%d" farm="1" server="2" secret="s"/>' % i for i in ids)))
+
+        listing = flickr.PhotoListing(search, 12, workers=2, per_page=5, tags="frame")
+        self.assertEqual(len(listing), 12)
+        self.assertEqual([p.photoid for p in listing], [str(i) for i in range(0, 9) + range(10, 13)])
+        self.assertEqual(sorted(page for page, per_page, kwargs in calls), [1, 2, 3])
+        self.assertEqual(calls[0], (1, 5, {'tags': "frame"}))
+        # Iterating again doesn't ask Flickr again
+        self.assertEqual(len(list(listing)), 12)
+        self.assertEqual(len(calls), 3)
+
+        # The skipped photo leaves the first three pages one short, so the fourth is fetched too
+        del calls[:]
+        listing = flickr.PhotoListing(search, 15, workers=2, per_page=5)
+        self.assertEqual([p.photoid for p in listing], [str(i) for i in range(0, 9) + range(10, 16)])
+        self.assertEqual(sorted(page for page, per_page, kwargs in calls), [1, 2, 3, 4])
+
+        listing = flickr.PhotoListing(search, 0)
+        self.assertEqual(len(listing), 0)
+        self.assertEqual(list(listing), [])
+
+    def _rsp(self, photos):
+        return ET.fromstring('<rsp stat="ok"><photos page="1" pages="1" total="%d">%s</photos></rsp>' % (
+                len(photos), "".join('<photo id="%s" farm="1" server="2" secret="%s" dateupload="%d" tags="%s"/>' % p
+                                     for p in photos)))
+
+    def test_incremental_listing(self):
+        index = flickr.PhotoIndex()
+        self.flickr.index = index
+        self.flickr.api_key = "key"
+        self.flickr.flickr = MagicMock()
+        self.flickr.flickr.photos_search.return_value = self._rsp(
+                [("3", "a", 300, "frame"), ("2", "b", 200, "frame other"), ("1", "c", 100, "frame")])
+        urls = []
+        def download_iter(jobs, cache):
+            jobs = list(jobs)
+            urls[:] = [url for url, fn in jobs]
+            return [(url, fn, None) for url, fn in jobs]
+        self.downloader.download_iter.side_effect = download_iter
+
+        self.flickr.get_tagged(["Frame"], 3, "photos")
+        self.assertEqual(self.flickr.flickr.photos_search.call_count, 1)
+        self.assertEqual(self.flickr.flickr.photos_search.call_args[1]['tags'], "Frame")
+
+        # Photo 4 is new, 2 lost its tag and 3 has a new secret
+        self.flickr.flickr.photos_recentlyUpdated.return_value = self._rsp(
+                [("4", "d", 400, "frame"), ("2", "b", 200, "other"), ("3", "e", 300, "frame")])
+        stream = self.flickr.get_tagged(["Frame"], 3, "photos", stream=True)
+        self.assertEqual(self.flickr.flickr.photos_search.call_count, 1)
+        self.assertEqual(stream.filenames, ["photos/4.jpg", "photos/3.jpg", "photos/1.jpg"])
+        list(stream)
+        self.assertEqual(urls[1], "http://farm1.staticflickr.com/2/3_e_b.jpg")
+        min_date = self.flickr.flickr.photos_recentlyUpdated.call_args[1]['min_date']
+        self.assertTrue(min_date <= index.listings["tags:frame"]['listed_at'])
+
+        # A day later, list everything again to catch deleted photos
+        index.listings["tags:frame"]['full_listed_at'] -= flickr.PhotoIndex.FULL_LISTING_INTERVAL + 1
+        self.flickr.get_tagged(["Frame"], 3, "photos")
+        self.assertEqual(self.flickr.flickr.photos_search.call_count, 2)
+
+    def test_listing_gap_forces_full_listing(self):
+        self.flickr.index = flickr.PhotoIndex()
+        self.flickr.api_key = "key"
+        self.flickr.flickr = MagicMock()
+        # Only the newest two of the three tagged photos are listed
+        rsp = ET.fromstring('<rsp stat="ok"><photos page="1" pages="2" total="3">%s</photos></rsp>' % "".join(
+                '<photo id="%s" farm="1" server="2" secret="s" dateupload="%d" tags="frame"/>' % (i, i) for i in (3, 2)))
+        self.flickr.flickr.photos_search.return_value = rsp
+        self.assertEqual([p.photoid for p in self.flickr._list_photos("tags:frame", 2, self.flickr.flickr.photos_search,
+                                                                     lambda photo: True)], ["3", "2"])
+        self.assertEqual(self.flickr.index.listings["tags:frame"]['total'], 3)
+
+        # Photo 3 was deleted, so photo 1 has to be listed to fill its place
+        self.flickr.flickr.photos_recentlyUpdated.return_value = self._rsp([("3", "s", 3, "")])
+        list(self.flickr._list_photos("tags:frame", 2, self.flickr.flickr.photos_search,
+                                      lambda photo: "frame" in photo.attrs['tags']))
+        self.assertEqual(self.flickr.flickr.photos_search.call_count, 2)
+
+    def test_saved_token(self):
+        tmpdir = tempfile.mkdtemp()
+        cwd = os.getcwd()
+        os.chdir(tmpdir)
+        try:
+            with patch('flickrapi.FlickrAPI') as api:
+                api.return_value.get_token_part_one.return_value = ("token1", None)
+                api.return_value.get_token_part_two.return_value = "token1"
+                self.flickr.set_keys("key", "secret")
+                self.flickr.get_auth2()
+                self.assertEqual(stat.S_IMODE(os.stat(flickr.TOKEN_FILE).st_mode), 0600)
+
+                # The next run uses the saved token without any calls to Flickr
+                api.reset_mock()
+                self.flickr.get_auth2()
+                api.assert_called_once_with("key", "secret", token="token1")
+                self.assertFalse(api.return_value.get_token_part_one.called)
+
+                # A revoked token is replaced, and the call retried
+                search = api.return_value.photos_search
+                search.side_effect = [flickrapi.FlickrError("Error: 98: Invalid auth token"), "photos"]
+                api.return_value.get_token_part_two.return_value = "token2"
+                self.assertEqual(self.flickr._api('photos_search')(tags="frame"), "photos")
+                self.assertEqual(self.flickr.read_token(), "token2")
+
+                search.side_effect = flickrapi.FlickrError("Error: 1: Tag not found")
+                self.assertRaises(flickrapi.FlickrError, self.flickr._api('photos_search'))
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+    unittest.main()
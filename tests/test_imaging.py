@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_imaging
+----------------------------------
+
+Tests for `imaging` module.
+"""
+
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+from PIL import Image
+
+from airframe import imaging
+from airframe.naming import ContentHasher
+
+
+class TestImaging(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def _make_image(self, name, size):
+        filename = os.path.join(self.tmpdir, name)
+        Image.new('RGB', size, (200, 100, 50)).save(filename)
+        return filename
+
+    def test_resize_images_in_parallel(self):
+        big = self._make_image("big.jpg", (800, 600))
+        small = self._make_image("small.jpg", (100, 50))
+        broken = os.path.join(self.tmpdir, "broken.jpg")
+        with open(broken, 'wb') as f:
+            f.write("not a jpeg")
+
+        results = imaging.resize_images([big, broken, small], (400, 400), jobs=2)
+        self.assertEqual([fn for fn, error in results], [big, broken, small])
+        self.assertEqual([error is None for fn, error in results], [True, False, True])
+        self.assertEqual(Image.open(big).size, (400, 300))
+        self.assertEqual(Image.open(small).size, (100, 50))
+
+    def test_fit_size(self):
+        self.assertEqual(imaging.fit_size((800, 600), (400, 400)), (400, 300))
+        self.assertEqual(imaging.fit_size((600, 800), (400, 400)), (300, 400))
+        self.assertEqual(imaging.fit_size((100, 50), (400, 400)), (100, 50))
+        self.assertEqual(imaging.fit_size((4000, 10), (400, 400)), (400, 1))
+
+    def test_shrink_decodes_jpegs_at_reduced_scale(self):
+        big = self._make_image("big.jpg", (1600, 1200))
+        im = Image.open(big)
+        small = imaging.shrink(im, (200, 200))
+        self.assertEqual(small.size, (200, 150))
+        # Decoded at 1/4 scale, rather than full size
+        self.assertEqual(im.size, (400, 300))
+        self.assertEqual(small.getpixel((100, 75)), Image.open(big).getpixel((800, 600)))
+
+        im = Image.open(big)
+        self.assertIs(imaging.shrink(im, (2000, 2000)), im)
+
+    def test_parse_bytes(self):
+        self.assertEqual(imaging.parse_bytes("300000"), 300000)
+        self.assertEqual(imaging.parse_bytes("300k"), 300*1024)
+        self.assertEqual(imaging.parse_bytes("1.5M"), 1536*1024)
+
+    def test_encode_to_byte_budget(self):
+        noisy = Image.effect_noise((400, 300), 60).convert('RGB')
+        full = imaging.encode_jpeg(noisy, quality=95)
+        budget = len(full) / 3
+        data = imaging.encode_jpeg(noisy, quality=95, max_bytes=budget, optimize=True)
+        self.assertLessEqual(len(data), budget)
+        self.assertEqual(Image.open(io.BytesIO(data)).size, (400, 300))
+        # Impossible budgets fall back to the lowest quality
+        self.assertEqual(imaging.encode_jpeg(noisy, max_bytes=10),
+                         imaging.encode_jpeg(noisy, quality=imaging.MIN_QUALITY))
+
+    def test_resize_applies_orientation_and_strips_metadata(self):
+        filename = os.path.join(self.tmpdir, "rotated.jpg")
+        exif = Image.Exif()
+        exif[imaging.ORIENTATION_TAG] = 6
+        Image.new('RGB', (800, 400), (200, 100, 50)).save(filename, exif=exif.tobytes())
+        target = os.path.join(self.tmpdir, "out.jpg")
+
+        [(fn, error)] = imaging.resize_images([filename], (400, 400), jobs=1, targets=[target])
+        self.assertIsNone(error)
+        im = Image.open(target)
+        self.assertEqual(im.size, (200, 400))
+        self.assertIsNone(im._getexif())
+
+    def test_derivative_cache(self):
+        big = self._make_image("big.jpg", (800, 600))
+        other = self._make_image("other.jpg", (600, 800))
+        cache_dir = os.path.join(self.tmpdir, "derived")
+        cache = imaging.DerivativeCache(cache_dir, ContentHasher())
+
+        [(small, error)] = cache.resize([big], (400, 400), jobs=1)
+        self.assertIsNone(error)
+        self.assertEqual(os.path.basename(small), "big.jpg")
+        self.assertEqual(Image.open(small).size, (400, 300))
+        self.assertEqual(Image.open(big).size, (800, 600))
+
+        # Hit after reloading the index, and a different box is a different entry
+        cache = imaging.DerivativeCache(cache_dir, ContentHasher())
+        self.assertEqual(cache.resize([big], (400, 400), jobs=1), [(small, None)])
+        [(smaller, error)] = cache.resize([big], (200, 200), jobs=1)
+        self.assertNotEqual(smaller, small)
+        self.assertEqual(Image.open(smaller).size, (200, 150))
+
+        # The least recently used entries are evicted, but never the ones just asked for
+        cache.max_bytes = 1
+        [(other_small, error)] = cache.resize([other], (400, 400), jobs=1)
+        self.assertTrue(os.path.exists(other_small))
+        self.assertFalse(os.path.exists(small))
+        self.assertFalse(os.path.exists(smaller))
+        self.assertEqual(len(cache.index), 1)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_multipart
+----------------------------------
+
+Tests for `multipart` module.
+"""
+
+import cgi
+import os
+import shutil
+import tempfile
+import unittest
+from StringIO import StringIO
+
+from airframe.multipart import MultipartFileStream, TransferProgress
+
+
+class TestMultipartFileStream(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, "photo.jpg")
+        self.data = os.urandom(1000)
+        with open(self.filename, 'wb') as f:
+            f.write(self.data)
+
+    def test_streams_parseable_body(self):
+        progress = TransferProgress().start_file("A.JPG", len(self.data))
+        body = MultipartFileStream('file', 'A.JPG', self.filename, chunk_size=7, progress=progress)
+        pieces = []
+        while True:
+            piece = body.read(100)
+            if not piece:
+                break
+            pieces.append(piece)
+        content = ''.join(pieces)
+        self.assertEqual(len(content), len(body))
+        self.assertEqual(progress.sent, len(self.data))
+        self.assertTrue(body.file is None)
+
+        form = cgi.FieldStorage(fp=StringIO(content), environ={'REQUEST_METHOD': 'POST',
+                                'CONTENT_TYPE': body.content_type, 'CONTENT_LENGTH': str(len(content))})
+        self.assertEqual(form['file'].filename, 'A.JPG')
+        self.assertEqual(form['file'].value, self.data)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+if __name__ == '__main__':
+    unittest.main()
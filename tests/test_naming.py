@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_naming
+----------------------------------
+
+Tests for `naming` module.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from airframe.naming import ContentHasher, ContentNamer
+
+
+class FakeHasher(object):
+    def __init__(self, digests):
+        self.digests = digests
+
+    def digest(self, filename):
+        return self.digests[filename]
+
+    def save(self):
+        pass
+
+
+class TestContentNaming(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def test_identical_content_shares_a_name(self):
+        for name in ("flickr.jpg", "local.jpg"):
+            with open(os.path.join(self.tmpdir, name), 'wb') as f:
+                f.write("same picture")
+        namer = ContentNamer(ContentHasher())
+        names = namer.assign([os.path.join(self.tmpdir, x) for x in ("flickr.jpg", "local.jpg")])
+        self.assertEqual(len(set(names.values())), 1)
+
+    def test_collisions_resolve_deterministically(self):
+        digests = {'a': "deadbeef" + "1" * 32, 'b': "deadbeef" + "2" * 32, 'c': "0123abcd" + "3" * 32}
+        namer = ContentNamer(FakeHasher(digests))
+        names = namer.assign(['b', 'a', 'c'])
+        self.assertEqual(names, {'a': "DEADBEEF.JPG", 'b': "EADBEEF2.JPG", 'c': "0123ABCD.JPG"})
+        self.assertEqual(namer.collisions, 1)
+        self.assertEqual(namer('b'), "EADBEEF2.JPG")
+
+    def test_hash_cache_avoids_rereading(self):
+        filename = os.path.join(self.tmpdir, "photo.jpg")
+        with open(filename, 'wb') as f:
+            f.write("picture")
+        cache_filename = os.path.join(self.tmpdir, "cache", "hashes.json")
+        hasher = ContentHasher(cache_filename)
+        digest = hasher.digest(filename)
+        hasher.save()
+
+        hasher = ContentHasher(cache_filename)
+        with mock.patch('airframe.naming.open', create=True) as mock_open:
+            self.assertEqual(hasher.digest(filename), digest)
+            self.assertFalse(mock_open.called)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_pipeline
+----------------------------------
+
+Tests for `pipeline` module.
+"""
+
+import threading
+import unittest
+
+from airframe import pipeline
+
+
+class TestPipeline(unittest.TestCase):
+
+    def test_background_keeps_order(self):
+        self.assertEqual(list(pipeline.background(iter(range(100)), maxsize=2)), range(100))
+
+    def test_background_is_bounded(self):
+        produced = []
+        def produce():
+            for i in range(10):
+                produced.append(i)
+                yield i
+        items = pipeline.background(produce(), maxsize=2)
+        self.assertEqual(next(items), 0)
+        threading.Event().wait(0.3)
+        # One handed over, two queued and one waiting to be queued
+        self.assertTrue(len(produced) <= 4)
+        self.assertEqual(list(items), range(1, 10))
+
+    def test_background_raises_errors_in_consumer(self):
+        def produce():
+            yield 1
+            raise IOError("download failed")
+        items = pipeline.background(produce())
+        self.assertEqual(next(items), 1)
+        self.assertRaises(IOError, next, items)
+
+    def test_photo_stream(self):
+        stream = pipeline.PhotoStream(["a.jpg", "b.jpg"], iter(["a.jpg"]))
+        self.assertEqual(len(stream), 2)
+        self.assertEqual(list(stream), ["a.jpg"])
+
+if __name__ == '__main__':
+    unittest.main()
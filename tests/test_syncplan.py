@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+test_syncplan
+----------------------------------
+
+Tests for `syncplan` module.
+"""
+
+import unittest
+
+from airframe.syncplan import plan_sync
+
+
+class Entry(object):
+    def __init__(self, size):
+        self.size = size
+
+
+class TestPlanSync(unittest.TestCase):
+
+    def setUp(self):
+        self.sizes = {'a.jpg': 10, 'b.jpg': 20, 'c.jpg': 30, 'a2/a.jpg': 10}
+        self.namer = lambda path: path.split('/')[-1].upper()
+        self.card = {'A.JPG': Entry(10), 'B.JPG': Entry(5), 'OLD.JPG': Entry(7)}
+
+    def _plan(self, files, force=False):
+        return plan_sync(files, self.card, self.namer, force, getsize=self.sizes.get)
+
+    def test_plan(self):
+        plan = self._plan(['a.jpg', 'b.jpg', 'c.jpg', 'a2/a.jpg'])
+        self.assertEqual(plan.delete, ['B.JPG', 'OLD.JPG'])
+        self.assertEqual(plan.delete_bytes, 12)
+        self.assertEqual([x.path for x in plan.upload], ['b.jpg', 'c.jpg'])
+        self.assertEqual(plan.upload_bytes, 50)
+        self.assertEqual([x.path for x in plan.skip], ['a.jpg', 'a2/a.jpg'])
+        self.assertEqual(plan.keep, ['A.JPG'])
+        self.assertEqual([x.index for x in plan.upload], [2, 3])
+
+    def test_force(self):
+        plan = self._plan(['a.jpg'], force=True)
+        self.assertEqual(plan.delete, ['A.JPG', 'B.JPG', 'OLD.JPG'])
+        self.assertEqual([x.path for x in plan.upload], ['a.jpg'])
+        self.assertEqual(plan.keep, [])
+
+if __name__ == '__main__':
+    unittest.main()